@@ -1,24 +1,33 @@
 #!/usr/bin/python
 
-import cPickle
+import random
+import direct.directbase.DirectStart
 from direct.showbase.DirectObject import DirectObject
 from direct.fsm import FSM
 from direct.gui.OnscreenText import OnscreenText
 from direct.gui.DirectGui import *
 from pandac.PandaModules import GeomNode, Point2
 from hexabots import World, Mouse, Tile, Character
+from hexabots.arrayterrain import ArrayTerrain
+from hexabots import levelfile
+from hexabots import brushes
+from hexabots.journal import EditJournal
+from hexabots.loading import WorldLoader, WorldGenerator
+from hexabots.profiling import timed, install_keys
 
 
 class EditState(FSM.FSM):
     def __init__(self, name):
         FSM.FSM.__init__(self, name)
         self.defaultTransitions = {
-                'Height' : [ 'HeightDrag', 'Material', 'Character' ],
+                'Height' : [ 'HeightDrag', 'Material', 'Character', 'Brush' ],
                 'HeightDrag' : [ 'Height' ],
-                'Material' : [ 'MaterialDrag', 'Height', 'Character' ],
+                'Material' : [ 'MaterialDrag', 'Height', 'Character', 'Brush' ],
                 'MaterialDrag' : [ 'Material' ],
-                'Character' : [ 'CharacterDrag', 'Height', 'Material' ],
+                'Character' : [ 'CharacterDrag', 'Height', 'Material', 'Brush' ],
                 'CharacterDrag' : [ 'Character' ],
+                'Brush' : [ 'BrushDrag', 'Height', 'Material', 'Character' ],
+                'BrushDrag' : [ 'Brush' ],
                 }
 
     nextState = {
@@ -28,14 +37,25 @@ class EditState(FSM.FSM):
             ('Material', 'Character'): 'Character',
             ('Character', 'Height'): 'Height',
             ('Character', 'Material'): 'Material',
+            ('Height', 'Brush'): 'Brush',
+            ('Material', 'Brush'): 'Brush',
+            ('Character', 'Brush'): 'Brush',
+            ('Brush', 'Height'): 'Height',
+            ('Brush', 'Material'): 'Material',
+            ('Brush', 'Character'): 'Character',
             ('Height', 'mouse1'): 'HeightDrag',
             ('HeightDrag', 'mouse1-up'): 'Height',
             ('Material', 'mouse1'): 'MaterialDrag',
             ('MaterialDrag', 'mouse1-up'): 'Material',
             ('Character', 'mouse1'): 'CharacterDrag',
             ('CharacterDrag', 'mouse1-up'): 'Character',
+            ('Brush', 'mouse1'): 'BrushDrag',
+            ('BrushDrag', 'mouse1-up'): 'Brush',
             }
 
+    request = timed('EditState.request')(FSM.FSM.request)
+    demand = timed('EditState.demand')(FSM.FSM.demand)
+
     def defaultFilter(self, request, args):
         key = (self.state, request)
         return self.nextState.get(key)
@@ -47,6 +67,7 @@ class EditState(FSM.FSM):
         app.mouse.task = None
 
     def enterHeightDrag(self):
+        app.journal.begin()
         app.selected_object = app.mouse.hovered_object
         if app.selected_object:
             app.selected_object.old_height = app.selected_object.height
@@ -54,6 +75,7 @@ class EditState(FSM.FSM):
             app.mouse.task = app.mouse.height_drag
 
     def exitHeightDrag(self):
+        app.journal.end()
         if app.selected_object:
             del app.selected_object.old_height
             app.selected_object = None
@@ -67,12 +89,14 @@ class EditState(FSM.FSM):
         app.mouse.task = None
 
     def enterMaterialDrag(self):
+        app.journal.begin()
         app.selected_object = app.mouse.hovered_object
         if app.selected_object:
             app.mouse.drag_start = Point2(app.mouse.pos.getX(), app.mouse.pos.getY())
             app.mouse.task = app.mouse.material_drag
 
     def exitMaterialDrag(self):
+        app.journal.end()
         if app.selected_object:
             app.selected_object = None
             app.mouse.drag_start = None
@@ -85,6 +109,7 @@ class EditState(FSM.FSM):
         app.mouse.task = None
 
     def enterCharacterDrag(self):
+        app.journal.begin()
         app.selected_object = app.mouse.hovered_object
         if app.selected_object:
             app.mouse.drag_start = Point2(app.mouse.pos.getX(), app.mouse.pos.getY())
@@ -93,19 +118,35 @@ class EditState(FSM.FSM):
                 inhabitants = app.world.terrain.rows[coords[0]][coords[1]].get_inhabitants()
                 if inhabitants:
                     for char in inhabitants:
-                        app.world.teams[char.team.index].delete_character(char.id)
+                        app.journal.delete_character(char)
                 else:
-                    char = app.world.teams[team_mode[0]].add_character(*coords)
-                    if char:
-                        char.init_nodepath()
+                    app.journal.add_character(team_mode[0], *coords)
             app.mouse.task = app.mouse.character_drag
 
     def exitCharacterDrag(self):
+        app.journal.end()
         if app.selected_object:
             app.selected_object = None
             app.mouse.drag_start = None
             app.mouse.task = None
 
+    def enterBrush(self):
+        app.mouse.task = app.mouse.hover
+
+    def exitBrush(self):
+        app.mouse.task = None
+
+    def enterBrushDrag(self):
+        app.journal.begin()
+        app.stroke = brushes.Stroke(app.world.terrain, brush_mode[0], brush_radius[0],
+                material[0], random.randrange(1 << 31))
+        app.mouse.task = app.mouse.brush_drag
+
+    def exitBrushDrag(self):
+        app.journal.end()
+        app.stroke = None
+        app.mouse.task = None
+
 
 class EditMouse(Mouse):
 
@@ -115,10 +156,7 @@ class EditMouse(Mouse):
         drag_delta = self.pos - self.drag_start
         new_height = self.app.selected_object.old_height + drag_delta.getY() * 100
         new_height = max(2, new_height)
-        self.app.selected_object.set_height(new_height)
-        inhabitants = self.app.selected_object.get_inhabitants()
-        for character in inhabitants:
-            character.move_to(self.app.selected_object)
+        self.app.journal.set_height(self.app.selected_object, new_height)
         return task.cont
 
     def material_drag(self, task):
@@ -129,7 +167,7 @@ class EditMouse(Mouse):
             return task.cont
         self.app.selected_object = self.hovered_object
         if self.app.selected_object:
-            self.app.selected_object.change_material(material[0])
+            self.app.journal.change_material(self.app.selected_object, material[0])
         return task.cont
 
     def character_drag(self, task):
@@ -140,7 +178,18 @@ class EditMouse(Mouse):
             return task.cont
         inhabitants = self.hovered_object.get_inhabitants()
         if not inhabitants:
-            self.app.selected_object.move_to(self.hovered_object)
+            self.app.journal.move_character(self.app.selected_object, self.hovered_object)
+        return task.cont
+
+    def brush_drag(self, task):
+        self.hover(task)
+        if not isinstance(self.hovered_object, Tile) or not self.app.stroke:
+            return task.cont
+        (heights, materials) = self.app.stroke.apply(self.hovered_object.x, self.hovered_object.y)
+        if heights:
+            self.app.journal.set_heights(heights)
+        if materials:
+            self.app.journal.set_materials(materials)
         return task.cont
 
 
@@ -161,17 +210,34 @@ team_mode = [0]
 def set_team_mode(status=None):
     pass
 
+brush_mode = [brushes.RAISE]
+def set_brush_mode(status=None):
+    pass
+
+brush_radius = [brushes.DEFAULT_RADIUS]
+def change_brush_radius(delta):
+    brush_radius[0] = max(0, min(20, brush_radius[0] + delta))
+
 class EditApp(DirectObject):
     def __init__(self):
         base.disableMouse()
         self.selected_object = None
+        self.stroke = None
         self.init_mouse()
         self.state = EditState('state')
         self.world = World()
+        self.journal = EditJournal(self.world)
+        self.world_loader = None
         self.accept('c', self.generate_world)
+        self.accept('n', self.generate_noise_world)
         self.accept('s', self.save_world)
         self.accept('l', self.load_world)
         self.accept('d', self.delete_world)
+        self.accept('control-z', self.undo)
+        self.accept('control-y', self.redo)
+        self.accept('[', change_brush_radius, [-1])
+        self.accept(']', change_brush_radius, [1])
+        install_keys(self)
         self.init_buttons()
 
     def init_buttons(self):
@@ -185,6 +251,9 @@ class EditApp(DirectObject):
                 DirectRadioButton(text='Character', variable=mouse_mode,
                         value=['Character'], scale=0.05, pos=(0.75, 0, -0.9),
                         command=set_mouse_mode),
+                DirectRadioButton(text='Brush', variable=mouse_mode,
+                        value=['Brush'], scale=0.05, pos=(-0.3, 0, -0.9),
+                        command=set_mouse_mode),
         ]
         for button in mode_buttons:
             button.setOthers(mode_buttons)
@@ -211,17 +280,41 @@ class EditApp(DirectObject):
         ]
         for button in character_buttons:
             button.setOthers(character_buttons)
+        brush_buttons = [
+                DirectRadioButton(text=brush.capitalize(), variable=brush_mode,
+                        value=[brush], scale=0.05, pos=(-0.3, 0, 0.9 - 0.1 * i),
+                        command=set_brush_mode)
+                for (i, brush) in enumerate(brushes.BRUSHES)
+        ]
+        for button in brush_buttons:
+            button.setOthers(brush_buttons)
 
     def init_mouse(self):
         self.mouse = EditMouse(self)
 
-    def generate_world(self):
+    def generate_world(self, seed=None):
+        # A flat board is made at once; a noise map is generated in the
+        # background, like a level being loaded
         self.delete_world()
-        self.world = World()
+        if seed is not None:
+            def generated(world):
+                self.world_loader = None
+                if world:
+                    self.world = world
+                    self.journal = EditJournal(self.world)
+                    self.world.position_camera()
+                    self.show_message('World created from seed %u.' % (seed,))
+            self.world_loader = WorldGenerator(seed, generated)
+            return
+        self.world = World(ArrayTerrain)
         self.world.generate()
+        self.journal = EditJournal(self.world)
         self.world.init_nodepath()
         self.world.position_camera()
-        text = OnscreenText(text='World created.', pos=(-0.9, -0.9), fg=(1.0, 1.0, 1.0, 1.0))
+        self.show_message('World created.')
+
+    def show_message(self, message):
+        text = OnscreenText(text=message, pos=(-0.9, -0.9), fg=(1.0, 1.0, 1.0, 1.0))
         def fadeText(task):
             alpha = 1.0 - task.time * 6.0
             if alpha > 0:
@@ -232,27 +325,50 @@ class EditApp(DirectObject):
                 return task.done
         taskMgr.doMethodLater(1.0, fadeText, 'fade')
 
+    def generate_noise_world(self):
+        self.generate_world(random.randrange(1 << 31))
+
     def save_world(self):
+        if self.world_loader:
+            return
         def save(filename):
-            F = open(filename, 'wb')
-            cPickle.dump(self.world, F, True)
-            F.close()
+            levelfile.save_world(self.world, filename)
             entry.destroy()
         entry = DirectEntry(text='', scale=0.05, command=save,
                 initialText='level.hm', focus=1)
 
     def load_world(self):
         def load(filename):
-            self.delete_world()
-            F = open(filename, 'rb')
-            self.world = cPickle.load(F)
-            F.close()
             entry.destroy()
-            self.world.position_camera()
+            self.delete_world()
+            self.world_loader = WorldLoader(filename, loaded)
+        def loaded(world):
+            self.world_loader = None
+            if world:
+                self.world = world
+                self.journal = EditJournal(self.world)
+                self.world.position_camera()
         entry = DirectEntry(text='', scale=0.05, command=load,
                 initialText='level.hm', focus=1)
 
+    def cancel_load(self):
+        if self.world_loader:
+            self.world_loader.cancel()
+            self.world_loader = None
+
+    # Undo, redo and saving wait for a load to finish, as until then the
+    # journal and self.world belong to the board that was cleared
+
+    def undo(self):
+        if not self.world_loader:
+            self.journal.undo()
+
+    def redo(self):
+        if not self.world_loader:
+            self.journal.redo()
+
     def delete_world(self):
+        self.cancel_load()
         self.world.clear()
 
 app = EditApp()
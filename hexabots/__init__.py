@@ -1,9 +1,12 @@
 #!/usr/bin/python
 
 import math, copy, random, sys
-import direct.directbase.DirectStart
 from direct.showbase.DirectObject import DirectObject
-from pandac.PandaModules import BitMask32, GeomNode, VBase4, NodePath, Point2
+from pandac.PandaModules import BitMask32, GeomNode, VBase4, NodePath, Point2, Point3
+from hexabots import hexgrid
+from hexabots.profiling import timed
+from hexabots.scheduler import CTScheduler
+from hexabots.hexgrid import EUCLIDEAN, HEX
 
 HEX_DIAM = 10
 BOARD_X = 160
@@ -13,6 +16,11 @@ RAD_TO_DEG = 180.0 / math.pi
 DEG_TO_RAD = 1.0 / RAD_TO_DEG
 # tan(INTERIOR_ANGLE / 2) * sin(IDEAL_AZIMUTH) == 1
 IDEAL_AZIMUTH = math.asin(1.0 / math.tan(60.0 * DEG_TO_RAD)) * RAD_TO_DEG
+MATERIAL_COLORS = {
+        'grass': VBase4(0, .7, 0, 1.0),
+        'stone': VBase4(.5, .5, .5, 1.0),
+        'water': VBase4(0, 0, .7, 1.0),
+}
 
 def board_coordinates(x, y, z):
     board_x = 0.75 * HEX_DIAM * x
@@ -20,41 +28,33 @@ def board_coordinates(x, y, z):
     return (board_x, board_y, z)
 
 def get_adjacent(terrain, x, y):
-    if x % 2 == 0:
-        coords = [(x-1, y), (x, y+1), (x+1, y), (x+1, y-1), (x, y-1), (x-1, y-1)]
-    else:
-        coords = [(x-1, y+1), (x, y+1), (x+1, y+1), (x+1, y), (x, y-1), (x-1, y)]
+    size_y = terrain.size_y
+    rows = terrain.rows
     adjacent = []
-    for coord in coords:
-        if coord[0] < 0 or coord[1] < 0:
-            adjacent.append(None)
-        elif coord[0] >= terrain.size_x or coord[1] >= terrain.size_y:
+    for index in terrain.get_tables().neighbours_of(x * size_y + y):
+        if index < 0:
             adjacent.append(None)
         else:
-            adjacent.append(terrain.rows[coord[0]][coord[1]])
+            adjacent.append(rows[index // size_y][index % size_y])
     return adjacent
 
 def tile_distance_squared(tile1, tile2):
-    (x1, y1, z1) = board_coordinates(tile1.x, tile1.y, 0)
-    (x2, y2, z2) = board_coordinates(tile2.x, tile2.y, 0)
-    vector = Point2(x1, y1) - Point2(x2, y2)
-    return vector.lengthSquared()
-
-def find_nearby(terrain, x, y, distance):
-    nearby = []
-    distance_squared = (distance * HEX_DIAM) ** 2.0
-    (pos_x, pos_y, pos_z) = board_coordinates(x, y, 0)
-    for x2, row in enumerate(terrain.rows):
-        for y2, tile in enumerate(row):
-            (pos_x2, pos_y2, pos_z2) = board_coordinates(tile.x, tile.y, 0)
-            vector = Point2(pos_x, pos_y) - Point2(pos_x2, pos_y2)
-            length_squared = vector.lengthSquared()
-            if length_squared <= distance_squared:
-                nearby.append(tile)
-    return nearby
+    terrain = tile1.terrain
+    positions = terrain.get_tables().positions
+    i = 2 * (tile1.x * terrain.size_y + tile1.y)
+    j = 2 * (tile2.x * terrain.size_y + tile2.y)
+    (dx, dy) = (positions[i] - positions[j], positions[i + 1] - positions[j + 1])
+    return dx * dx + dy * dy
+
+def find_nearby(terrain, x, y, distance, metric=EUCLIDEAN):
+    return terrain.tiles_in_range(x, y, distance, metric)
 
 
 class Mouse(DirectObject):
+    # 'analytic' walks the camera ray over the heightfield; 'collide' runs a
+    # CollisionTraverser over the terrain's scene graph.
+    pick_mode = 'analytic'
+
     def __init__(self, app):
         self.app = app
         self.init_collide()
@@ -85,15 +85,30 @@ class Mouse(DirectObject):
         self.cNode.addSolid(self.cRay)
         self.cTrav.addCollider(self.cNodePath, self.cQueue)
 
+    @timed('Mouse.find_object')
     def find_object(self):
         if self.app.world.nodePath:
             self.cRay.setFromLens(base.camNode, self.pos.getX(), self.pos.getY())
             self.cTrav.traverse(self.app.world.terrain.nodePath)
             if self.cQueue.getNumEntries() > 0:
                 self.cQueue.sortEntries()
-                return self.cQueue.getEntry(0).getIntoNodePath()
+                return self.cQueue.getEntry(0)
         return None
 
+    @timed('Mouse.pick')
+    def pick(self):
+        from hexabots import picking
+        if not self.app.world.nodePath:
+            return None
+        terrain = self.app.world.terrain
+        (near, far) = (Point3(), Point3())
+        if not base.camLens.extrude(self.pos, near, far):
+            return None
+        near = terrain.nodePath.getRelativePoint(base.cam, near)
+        far = terrain.nodePath.getRelativePoint(base.cam, far)
+        return picking.pick(terrain, near, far)
+
+    @timed('Mouse.mouse_task')
     def mouse_task(self, task):
         action = task.cont
         self.has_mouse = base.mouseWatcherNode.hasMouse()
@@ -111,14 +126,29 @@ class Mouse(DirectObject):
             self.prev_pos = Point2(self.pos.getX(), self.pos.getY())
         return action
 
+    @timed('Mouse.hover')
     def hover(self, task):
         if self.hovered_object:
             self.hovered_object.unhover()
             self.hovered_object = None
         if self.button2:
             self.camera_drag()
-        hovered_nodePath = self.find_object()
-        if hovered_nodePath:
+        if self.pick_mode == 'analytic':
+            self.hovered_object = self.pick()
+            if self.hovered_object:
+                self.hovered_object.hover()
+            return task.cont
+        entry = self.find_object()
+        if entry:
+            hovered_nodePath = entry.getIntoNodePath()
+            chunk = hovered_nodePath.findNetTag('chunk')
+            if not chunk.isEmpty():
+                terrain = self.app.world.terrain
+                # Step just inside the face that was hit to find its column
+                point = entry.getSurfacePoint(terrain.nodePath) - entry.getSurfaceNormal(terrain.nodePath) * 0.01
+                self.hovered_object = terrain.mesh.tile_at(point)
+                if self.hovered_object:
+                    self.hovered_object.hover()
             tile = hovered_nodePath.findNetTag('tile')
             if not tile.isEmpty():
                 tag = tile.getTag('tile')
@@ -160,11 +190,13 @@ class Mouse(DirectObject):
         lens = base.cam.node().getLens()
         size = lens.getFilmSize()
         lens.setFilmSize(size / 1.2)
+        self.app.world.update_lod()
 
     def zoomOut(self):
         lens = base.cam.node().getLens()
         size = lens.getFilmSize()
         lens.setFilmSize(size * 1.2)
+        self.app.world.update_lod()
 
 
 class Team(DirectObject):
@@ -176,19 +208,25 @@ class Team(DirectObject):
         self.characters = []
         self.characters_dict = {}
 
-    def add_character(self, x, y):
-        character_id = random.randint(0, 256)
-        while self.characters_dict.has_key(character_id):
+    def add_character(self, x, y, character_id=None):
+        while character_id is None or self.characters_dict.has_key(character_id):
             character_id = random.randint(0, 256)
         char = Character(self.world.terrain, self, character_id, x, y)
         self.characters.append(char)
         self.characters_dict[character_id] = char
+        self.world.terrain.add_occupant(char)
+        if self.world.fog:
+            self.world.fog.update(char)
         return char
 
     def delete_character(self, character_id):
         for i, char in enumerate(self.characters):
             if char == self.characters_dict[character_id]:
-                char.nodePath.removeNode()
+                self.world.terrain.remove_occupant(char)
+                if self.world.fog:
+                    self.world.fog.remove(char)
+                if char.nodePath:
+                    char.nodePath.removeNode()
                 del self.characters[i]
         del self.characters_dict[character_id]
 
@@ -213,16 +251,21 @@ class Character(DirectObject):
         self.nodePath = loader.loadModel('models/character')
         self.nodePath.reparentTo(self.terrain.nodePath)
         self.nodePath.setColor(VBase4(*self.color))
-        (pos_x, pos_y, pos_z) = board_coordinates(self.x, self.y, self.height)
+        (pos_x, pos_y, pos_z) = self.terrain.position(self.x, self.y, self.height)
         self.nodePath.setPos(pos_x, pos_y, pos_z)
         self.nodePath.setScale(5, 5, 5)
         self.nodePath.setTag('char', '%u,%u' % (self.team.index, self.id))
 
     def move_to(self, tile):
+        self.terrain.remove_occupant(self)
         self.tile = tile
         (self.x, self.y, self.height) = (tile.x, tile.y, tile.height)
-        (pos_x, pos_y, pos_z) = board_coordinates(self.x, self.y, self.height)
-        self.nodePath.setPos(pos_x, pos_y, pos_z)
+        self.terrain.add_occupant(self)
+        if self.nodePath:
+            (pos_x, pos_y, pos_z) = self.terrain.position(self.x, self.y, self.height)
+            self.nodePath.setPos(pos_x, pos_y, pos_z)
+        if self.team.world.fog:
+            self.team.world.fog.update(self)
 
     def hover(self):
         color = self.nodePath.getColor() * 1.5
@@ -239,17 +282,33 @@ class Character(DirectObject):
 
     def set_action(self, action):
         self.pending_action = action
+        self.sync_ct()
         self.CT -= self.pending_action.pre_cost()
+        self.reschedule()
 
     def do_action(self):
         self.pending_action.do()
+        self.sync_ct()
         self.CT -= self.pending_action.post_cost()
+        self.reschedule()
         self.pending_action = None
 
     def damage(self, damage):
+        self.sync_ct()
         self.efficiency -= damage
         if self.should_die():
             self.efficiency = 0.0
+        self.reschedule()
+
+    def sync_ct(self):
+        scheduler = self.team.world.scheduler
+        if scheduler:
+            scheduler.sync(self)
+
+    def reschedule(self):
+        scheduler = self.team.world.scheduler
+        if scheduler:
+            scheduler.reschedule(self)
 
     def should_die(self):
         return bool(self.efficiency <= 0.0)
@@ -257,7 +316,12 @@ class Character(DirectObject):
     def die(self):
         print self, 'died'
         self.is_dead = True
-        self.nodePath.removeNode()
+        self.terrain.remove_occupant(self)
+        self.reschedule()
+        if self.team.world.fog:
+            self.team.world.fog.update(self)
+        if self.nodePath:
+            self.nodePath.removeNode()
 
     def __getstate__(self):
         safe_dict = self.__dict__.copy()
@@ -276,39 +340,50 @@ class Tile(DirectObject):
         self.x = x
         self.y = y
         self.height = height
-        self.adjacent = []
         self.nodePath = None
 
     def init_nodepath(self):
         self.nodePath = self.terrain.nodePath.attachNewNode('tile')
         cyl = loader.loadModel('models/tile-cyl').reparentTo(self.nodePath)
         cap = loader.loadModel('models/tile-cap').reparentTo(self.nodePath)
-        if self.material == 'grass':
-            new_color = VBase4(0, .7, 0, 1.0)
-        elif self.material == 'stone':
-            new_color = VBase4(.5, .5, .5, 1.0)
-        if self.material == 'water':
-            new_color = VBase4(0, 0, .7, 1.0)
-        self.nodePath.setColor(new_color)
-        (pos_x, pos_y, pos_z) = board_coordinates(self.x, self.y, 0)
+        self.nodePath.setColor(MATERIAL_COLORS[self.material])
+        (pos_x, pos_y, pos_z) = self.terrain.position(self.x, self.y)
         self.nodePath.setPos(pos_x, pos_y, pos_z)
         self.set_height(self.height)
         self.nodePath.setTag('tile', '%u,%u' % (self.x, self.y))
 
+    def get_color(self):
+        if self.nodePath:
+            return self.nodePath.getColor()
+        return self.terrain.mesh.get_tile_color(self.x, self.y)
+
+    def set_color(self, color):
+        if self.nodePath:
+            self.nodePath.setColor(color)
+        else:
+            self.terrain.mesh.set_tile_color(self.x, self.y, color)
+
     def hover(self):
         self.terrain.hoveredTile = self
-        color = self.nodePath.getColor() * 1.5
-        self.nodePath.setColor(color)
+        color = self.get_color() * 1.5
+        self.set_color(color)
 
     def unhover(self):
         self.terrain.hoveredTile = None
-        color = self.nodePath.getColor() / 1.5
-        self.nodePath.setColor(color)
+        color = self.get_color() / 1.5
+        self.set_color(color)
 
     def set_height(self, new_height):
-        self.height = round(new_height / 2.0) * 2
-        self.nodePath.find('**/tile-cyl.egg').setSz(self.height)
-        self.nodePath.find('**/tile-cap.egg').setZ(self.height - 1.0)
+        new_height = round(new_height / 2.0) * 2
+        changed = new_height != self.height
+        self.height = new_height
+        if changed:
+            self.terrain.heights_changed([(self.x, self.y)])
+        if self.nodePath:
+            self.nodePath.find('**/tile-cyl.egg').setSz(self.height)
+            self.nodePath.find('**/tile-cap.egg').setZ(self.height - 1.0)
+        elif self.terrain.mesh:
+            self.terrain.mesh.update_tile(self.x, self.y)
 
     def select(self):
         self.terrain.selectedTile = self
@@ -317,38 +392,51 @@ class Tile(DirectObject):
         self.terrain.selectedTile = None
 
     def change_material(self, new_material):
+        if new_material != self.material:
+            self.terrain.touch()
         self.material = new_material
-        if self.material == 'grass':
-            new_color = VBase4(0, .7, 0, 1.0)
-        elif self.material == 'stone':
-            new_color = VBase4(.5, .5, .5, 1.0)
-        if self.material == 'water':
-            new_color = VBase4(0, 0, .7, 1.0)
+        new_color = MATERIAL_COLORS[self.material]
         if self.terrain.hoveredTile == self:
-            new_color *= 1.5
-        self.nodePath.setColor(new_color)
+            new_color = new_color * 1.5
+        self.set_color(new_color)
 
     def get_inhabitants(self):
-        characters = []
-        for team in self.terrain.world.teams:
-            for character in team.characters:
-                if character.is_dead:
-                    continue
-                if (character.x, character.y) == (self.x, self.y):
-                    characters.append(character)
-        return characters
+        return self.terrain.occupants_at(self.x, self.y)
+
+    @property
+    def adjacent(self):
+        return get_adjacent(self.terrain, self.x, self.y)
 
     def __getstate__(self):
         safe_dict = self.__dict__.copy()
         safe_dict['nodePath'] = None
-        safe_dict['adjacent'] = []
         return safe_dict
 
     def __setstate__(self, safe_dict):
         self.__dict__.update(safe_dict)
+        # Older levels stored each tile's neighbour list
+        self.__dict__.pop('adjacent', None)
 
 
 class Terrain(DirectObject):
+    # Build the terrain as merged chunk meshes rather than a node per tile
+    merged_geometry = True
+    mesh = None
+    pathfinder = None
+    highlights = None
+    # Neighbour and position tables from hexabots.boardtables
+    tables = None
+    sight = None
+    # Called with the (x, y) of columns whose height changed, or None when
+    # any of them may have
+    height_listeners = ()
+    # No column is taller than this; edits raise it and whole-board changes
+    # leave it to be worked out again
+    top_height = None
+    # Bumped whenever heights, materials or occupancy change, so cached
+    # results such as movement ranges know when they are stale.
+    version = 0
+
     def __init__(self, world):
         self.world = world
         self.rows = []
@@ -356,15 +444,190 @@ class Terrain(DirectObject):
         self.selectedTile = None
         self.size_x = BOARD_X
         self.size_y = BOARD_Y
+        self.occupants = {}
         self.nodePath = None
 
     def init_nodepath(self):
+        for progress in self.build_nodepath():
+            pass
+
+    def build_nodepath(self):
+        # Yields the fraction built so far, so that loading can spread the
+        # work over several frames.
+        if self.mesh:
+            self.mesh.clear()
         self.nodePath = self.world.nodePath.attachNewNode('Terrain')
-        for row in self.rows:
-            for tile in row:
-                tile.init_nodepath()
-
-    def generate(self):
+        if self.merged_geometry:
+            from hexabots.terrainmesh import TerrainMesh
+            self.mesh = TerrainMesh(self)
+            for progress in self.mesh.build_steps():
+                yield progress
+        else:
+            for x, row in enumerate(self.rows):
+                for tile in row:
+                    tile.init_nodepath()
+                yield float(x + 1) / self.size_x
+
+    def touch(self):
+        self.version += 1
+
+    def add_height_listener(self, listener):
+        if not self.height_listeners:
+            self.height_listeners = []
+        self.height_listeners.append(listener)
+
+    def remove_height_listener(self, listener):
+        if listener in self.height_listeners:
+            self.height_listeners.remove(listener)
+
+    def heights_changed(self, coords=None):
+        self.touch()
+        if coords is None:
+            self.top_height = None
+        elif self.top_height is not None:
+            self.top_height = max([self.top_height] + [self.height_at(x, y) for (x, y) in coords])
+        for listener in self.height_listeners:
+            listener(coords)
+
+    def max_height(self):
+        if self.top_height is None:
+            self.top_height = self.highest_column()
+        return self.top_height
+
+    def highest_column(self):
+        return max([tile.height for row in self.rows for tile in row] or [0.0])
+
+    def get_tables(self):
+        tables = self.tables
+        if tables is None or (tables.size_x, tables.size_y) != (self.size_x, self.size_y):
+            from hexabots.boardtables import get_tables
+            tables = self.tables = get_tables(self.size_x, self.size_y)
+        return tables
+
+    def position(self, x, y, z=0):
+        # board_coordinates of a tile, read from the position table
+        i = 2 * (x * self.size_y + y)
+        positions = self.get_tables().positions
+        return (positions[i], positions[i + 1], z)
+
+    def add_occupant(self, character):
+        self.occupants.setdefault((character.x, character.y), []).append(character)
+        self.touch()
+
+    def remove_occupant(self, character):
+        key = (character.x, character.y)
+        occupants = self.occupants.get(key)
+        if occupants and character in occupants:
+            self.touch()
+            occupants.remove(character)
+            if not occupants:
+                del self.occupants[key]
+
+    def occupants_at(self, x, y):
+        return list(self.occupants.get((x, y), ()))
+
+    def rebuild_occupants(self, teams):
+        self.occupants = {}
+        for team in teams:
+            for character in team.characters:
+                if not character.is_dead:
+                    self.add_occupant(character)
+
+    def tile(self, x, y):
+        return self.rows[x][y]
+
+    def height_at(self, x, y):
+        return self.rows[x][y].height
+
+    def material_at(self, x, y):
+        return self.rows[x][y].material
+
+    def store_height(self, x, y, height):
+        self.rows[x][y].height = height
+
+    def store_material(self, x, y, material):
+        self.rows[x][y].material = material
+
+    def set_heights(self, heights):
+        # Bulk Tile.set_height: heights maps (x, y) to a new height. Listeners
+        # hear about all the changed columns at once and each chunk of the
+        # merged mesh is rebuilt once. Returns the (x, y) that changed.
+        changed = []
+        for ((x, y), height) in heights.iteritems():
+            height = round(height / 2.0) * 2
+            if height != self.height_at(x, y):
+                changed.append((x, y))
+                self.store_height(x, y, height)
+        if not changed:
+            return changed
+        self.heights_changed(changed)
+        if self.mesh:
+            self.mesh.update_tiles(changed)
+        elif self.nodePath:
+            # Per-tile nodes only need their models rescaled
+            for (x, y) in changed:
+                self.tile(x, y).set_height(self.height_at(x, y))
+        for (x, y) in changed:
+            for character in self.occupants_at(x, y):
+                character.move_to(self.tile(x, y))
+        return changed
+
+    def set_materials(self, materials):
+        # Bulk Tile.change_material, recoloured in one batch. Returns the
+        # (x, y) that changed.
+        changed = []
+        for ((x, y), material) in materials.iteritems():
+            if material != self.material_at(x, y):
+                self.store_material(x, y, material)
+                changed.append((x, y))
+        if not changed:
+            return changed
+        self.touch()
+        if self.nodePath:
+            self.get_highlights().apply(changed)
+        return changed
+
+    def get_pathfinder(self):
+        if self.pathfinder is None:
+            from hexabots.pathing import PathFinder
+            self.pathfinder = PathFinder(self)
+        return self.pathfinder
+
+    def get_sight(self):
+        if self.sight is None:
+            from hexabots.sight import LineOfSight
+            self.sight = LineOfSight(self)
+        return self.sight
+
+    def get_highlights(self):
+        if self.highlights is None:
+            from hexabots.highlight import HighlightLayer
+            self.highlights = HighlightLayer(self)
+        return self.highlights
+
+    def set_tile_colors(self, colors):
+        # colors maps (x, y) to a colour
+        if self.mesh:
+            self.mesh.set_tile_colors(colors)
+        elif self.nodePath:
+            for ((x, y), color) in colors.iteritems():
+                self.tile(x, y).set_color(color)
+
+    def tiles_in_range(self, x, y, distance, metric=EUCLIDEAN):
+        coords = hexgrid.coords_in_range(self.size_x, self.size_y, x, y, distance, metric)
+        return [self.tile(x2, y2) for (x2, y2) in coords]
+
+    def ring(self, x, y, radius):
+        coords = hexgrid.ring(self.size_x, self.size_y, x, y, radius)
+        return [self.tile(x2, y2) for (x2, y2) in coords]
+
+    def spiral(self, x, y, radius):
+        coords = hexgrid.spiral(self.size_x, self.size_y, x, y, radius)
+        return [self.tile(x2, y2) for (x2, y2) in coords]
+
+    def generate(self, seed=None, **params):
+        # A flat grass board, or with a seed a noise map from
+        # hexabots.terraingen, which takes params
         for x in range(self.size_x):
             row = []
             for y in range(self.size_y):
@@ -373,47 +636,83 @@ class Terrain(DirectObject):
                 tile = Tile(self, material, x, y, height)
                 row.append(tile)
             self.rows.append(row)
-        for x in range(self.size_x):
-            for y in range(self.size_y):
-                self.rows[x][y].adjacent = get_adjacent(self, x, y)
+        if seed is not None:
+            from hexabots.terraingen import generate_fields
+            from hexabots.arrayterrain import MATERIALS
+            (heights, materials) = generate_fields(self.size_x, self.size_y, seed, **params)
+            for x in range(self.size_x):
+                for y in range(self.size_y):
+                    tile = self.rows[x][y]
+                    tile.height = heights[x * self.size_y + y]
+                    tile.material = MATERIALS[materials[x * self.size_y + y]]
+        self.heights_changed()
 
     def __getstate__(self):
         safe_dict = self.__dict__.copy()
         safe_dict['hoveredTile'] = None
         safe_dict['selectedTile'] = None
         safe_dict['nodePath'] = None
+        safe_dict.pop('mesh', None)
+        safe_dict.pop('pathfinder', None)
+        safe_dict.pop('highlights', None)
+        safe_dict.pop('tables', None)
+        safe_dict.pop('sight', None)
+        safe_dict.pop('height_listeners', None)
+        safe_dict.pop('top_height', None)
         return safe_dict
 
     def __setstate__(self, safe_dict):
         self.__dict__.update(safe_dict)
-        for x in range(self.size_x):
-            for y in range(self.size_y):
-                self.rows[x][y].adjacent = get_adjacent(self, x, y)
+        # Levels saved before the occupancy index get it rebuilt by World
+        if 'occupants' not in safe_dict:
+            self.occupants = None
 
 
 class World(DirectObject):
-    def __init__(self):
-        base.setBackgroundColor(0, 0.2, 0.5)
-        self.init_terrain()
+    scheduler = None
+    fog = None
+    # A headless world never touches ShowBase, so it can be used without a
+    # window, e.g. by hexabots.battle.
+    headless = False
+
+    def __init__(self, terrain_type=Terrain, headless=False):
+        self.headless = headless
+        if not headless:
+            base.setBackgroundColor(0, 0.2, 0.5)
+        self.init_terrain(terrain_type)
         self.init_teams()
-        self.position_camera()
+        if not headless:
+            self.position_camera()
         self.nodePath = None
 
     def init_nodepath(self):
+        for progress in self.build_nodepath():
+            pass
+
+    def build_nodepath(self):
+        # Like Terrain.build_nodepath, yields the fraction built so far
         self.nodePath = render.attachNewNode('World')
         self.init_lights()
         self.init_camera()
-        self.terrain.init_nodepath()
+        for progress in self.terrain.build_nodepath():
+            yield progress
         for team in self.teams:
             for character in team.characters:
                 character.init_nodepath()
+        yield 1.0
 
     def clear(self):
+        if self.fog:
+            self.fog.detach(redraw=False)
+            self.fog = None
+        if self.terrain.mesh:
+            self.terrain.mesh.clear()
         if self.nodePath:
             self.nodePath.removeNode()
+            self.nodePath = None
 
-    def generate(self):
-        self.terrain.generate()
+    def generate(self, seed=None, **params):
+        self.terrain.generate(seed, **params)
         self.teams = [
                 Team(self, 0, 'Team 1', (0.1, 0.1, 0.1, 1.0)),
                 Team(self, 1, 'Team 2', (0.9, 0.9, 0.9, 1.0)),
@@ -459,9 +758,25 @@ class World(DirectObject):
         base.cam.node().getLens().setFilmSize(width)
         (pos_x, pos_y, pos_z) = board_coordinates(self.terrain.size_x * 0.5, self.terrain.size_y * 0.5, 0)
         base.camera.setPos(pos_x, pos_y, 10)
+        self.update_lod()
+
+    def update_lod(self):
+        if self.terrain.mesh:
+            self.terrain.mesh.set_view_width(base.cam.node().getLens().getFilmSize().getX())
+
+    def init_terrain(self, terrain_type=Terrain):
+        self.terrain = terrain_type(self)
+
+    def init_scheduler(self):
+        self.scheduler = CTScheduler(self.teams)
 
-    def init_terrain(self):
-        self.terrain = Terrain(self)
+    def init_fog(self, viewer=None):
+        # Tracks what each team can see; with a viewer team, what it cannot
+        # see is fogged on screen
+        from hexabots.fog import FogOfWar
+        if self.fog:
+            self.fog.detach()
+        self.fog = FogOfWar(self, viewer)
 
     def init_teams(self):
         self.teams = []
@@ -469,8 +784,11 @@ class World(DirectObject):
     def __getstate__(self):
         safe_dict = self.__dict__.copy()
         safe_dict['nodePath'] = None
+        safe_dict.pop('scheduler', None)
+        safe_dict.pop('fog', None)
         return safe_dict
 
     def __setstate__(self, safe_dict):
         self.__dict__.update(safe_dict)
-        self.init_nodepath()
+        if self.terrain.occupants is None:
+            self.terrain.rebuild_occupants(self.teams)
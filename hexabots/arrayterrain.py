@@ -0,0 +1,163 @@
+# Terrain backend that keeps tile heights and materials in flat typed arrays
+# instead of a Tile object per tile. Tiles are handed out as lightweight views
+# over the arrays, so rows[x][y], tile.height and tile.material keep working.
+
+from array import array
+from hexabots import Terrain, Tile
+
+MATERIALS = ['grass', 'stone', 'water']
+MATERIAL_IDS = dict((name, i) for i, name in enumerate(MATERIALS))
+
+
+class ArrayTile(Tile, object):
+    def __init__(self, terrain, x, y):
+        self.terrain = terrain
+        self.x = x
+        self.y = y
+
+    def _get_height(self):
+        return self.terrain.heights[self.terrain.index(self.x, self.y)]
+
+    def _set_height(self, height):
+        self.terrain.heights[self.terrain.index(self.x, self.y)] = height
+
+    height = property(_get_height, _set_height)
+
+    def _get_material(self):
+        return MATERIALS[self.terrain.materials[self.terrain.index(self.x, self.y)]]
+
+    def _set_material(self, material):
+        self.terrain.materials[self.terrain.index(self.x, self.y)] = MATERIAL_IDS[material]
+
+    material = property(_get_material, _set_material)
+
+    def _get_nodePath(self):
+        return self.terrain.tile_nodes.get(self.terrain.index(self.x, self.y))
+
+    def _set_nodePath(self, nodePath):
+        index = self.terrain.index(self.x, self.y)
+        if nodePath is None:
+            self.terrain.tile_nodes.pop(index, None)
+        else:
+            self.terrain.tile_nodes[index] = nodePath
+
+    nodePath = property(_get_nodePath, _set_nodePath)
+
+    def __eq__(self, other):
+        return (isinstance(other, ArrayTile) and other.terrain is self.terrain
+                and other.x == self.x and other.y == self.y)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.terrain), self.x, self.y))
+
+    def __getstate__(self):
+        return {'terrain': self.terrain, 'x': self.x, 'y': self.y}
+
+    def __setstate__(self, safe_dict):
+        self.__dict__.update(safe_dict)
+
+
+class TileColumn(object):
+    def __init__(self, terrain, x):
+        self.terrain = terrain
+        self.x = x
+
+    def __len__(self):
+        return self.terrain.size_y
+
+    def __getitem__(self, y):
+        if not 0 <= y < self.terrain.size_y:
+            raise IndexError(y)
+        return ArrayTile(self.terrain, self.x, y)
+
+    def __iter__(self):
+        for y in xrange(self.terrain.size_y):
+            yield ArrayTile(self.terrain, self.x, y)
+
+
+class TileRows(object):
+    def __init__(self, terrain):
+        self.terrain = terrain
+
+    def __len__(self):
+        return self.terrain.size_x
+
+    def __getitem__(self, x):
+        if not 0 <= x < self.terrain.size_x:
+            raise IndexError(x)
+        return TileColumn(self.terrain, x)
+
+    def __iter__(self):
+        for x in xrange(self.terrain.size_x):
+            yield TileColumn(self.terrain, x)
+
+
+class ArrayTerrain(Terrain):
+    def __init__(self, world):
+        Terrain.__init__(self, world)
+        self.heights = array('f')
+        self.materials = array('B')
+        self.tile_nodes = {}
+        self.rows = TileRows(self)
+
+    def index(self, x, y):
+        return x * self.size_y + y
+
+    def tile(self, x, y):
+        return ArrayTile(self, x, y)
+
+    def height_at(self, x, y):
+        return self.heights[x * self.size_y + y]
+
+    def material_at(self, x, y):
+        return MATERIALS[self.materials[x * self.size_y + y]]
+
+    def store_height(self, x, y, height):
+        self.heights[x * self.size_y + y] = height
+
+    def highest_column(self):
+        return self.heights and max(self.heights) or 0.0
+
+    def store_material(self, x, y, material):
+        self.materials[x * self.size_y + y] = MATERIAL_IDS[material]
+
+    def resize(self, size_x, size_y, height=2, material='grass'):
+        self.size_x = size_x
+        self.size_y = size_y
+        self.heights = array('f', [height]) * (size_x * size_y)
+        self.materials = array('B', [MATERIAL_IDS[material]]) * (size_x * size_y)
+        self.tile_nodes = {}
+        self.heights_changed()
+
+    def generate(self, seed=None, **params):
+        self.resize(self.size_x, self.size_y)
+        if seed is not None:
+            from hexabots.terraingen import generate_fields
+            (self.heights, self.materials) = generate_fields(self.size_x, self.size_y,
+                    seed, **params)
+            self.heights_changed()
+
+    def build_nodepath(self):
+        self.tile_nodes = {}
+        return Terrain.build_nodepath(self)
+
+    def __getstate__(self):
+        safe_dict = Terrain.__getstate__(self)
+        safe_dict['heights'] = self.heights.tostring()
+        safe_dict['materials'] = self.materials.tostring()
+        safe_dict['tile_nodes'] = None
+        safe_dict['rows'] = None
+        return safe_dict
+
+    def __setstate__(self, safe_dict):
+        self.__dict__.update(safe_dict)
+        if 'occupants' not in safe_dict:
+            self.occupants = None
+        self.heights = array('f', safe_dict['heights'])
+        self.materials = array('B', safe_dict['materials'])
+        self.tile_nodes = {}
+        self.rows = TileRows(self)
+
@@ -0,0 +1,143 @@
+# Runs many headless battles over a process pool, e.g. every level against
+# several seeds and AI pairings, and streams the results back as they finish.
+# Each worker parses a level the first time it is asked for it and builds
+# every later battle on that level from the parsed copy.
+
+import os, random, sys, time
+from array import array
+from multiprocessing import Pool, cpu_count
+from hexabots import World
+from hexabots import battle, levelfile
+
+# Levels parsed by this worker, by filename
+_levels = {}
+
+
+class BattleResult(object):
+    def __init__(self, level, seed, ais, winner, turns, seconds):
+        self.level = level
+        self.seed = seed
+        self.ais = ais
+        self.winner = winner
+        self.turns = turns
+        self.seconds = seconds
+
+    def __repr__(self):
+        return '%s seed=%u ai=%s winner=%s turns=%u %.4fs' % (self.level, self.seed,
+                ','.join(self.ais), self.winner or 'Draw', self.turns, self.seconds)
+
+
+def _init_worker():
+    # Characters print as they die; nobody reads a worker's output.
+    sys.stdout = open(os.devnull, 'w')
+
+def get_level(filename):
+    level = _levels.get(filename)
+    if level is None:
+        level = _levels[filename] = levelfile.read_any_level(filename)
+    return level
+
+def play(job):
+    (filename, seed, ais, max_turns) = job
+    start = time.time()
+    level = get_level(filename)
+    random.seed(seed)
+    world = World(headless=True)
+    levelfile.build_world(level, world)
+    # build_world hands the level's arrays to the terrain; keep the cached
+    # copy clean for the next battle.
+    world.terrain.heights = array('f', level.heights)
+    world.terrain.materials = array('B', level.materials)
+    controllers = {}
+    for index, name in enumerate(ais):
+        controllers[index] = battle.AIS[name]
+    fight = battle.Battle(world, controllers)
+    winner = fight.run(max_turns)
+    return BattleResult(filename, seed, ais, winner and winner.name, fight.turns,
+            time.time() - start)
+
+def make_jobs(levels, seeds, pairings, max_turns=battle.MAX_TURNS):
+    jobs = []
+    for filename in levels:
+        for ais in pairings:
+            for seed in seeds:
+                jobs.append((filename, seed, tuple(ais), max_turns))
+    return jobs
+
+def run_jobs(jobs, processes=None, chunksize=4):
+    # Yields a BattleResult per job, in the order they finish
+    if processes == 1:
+        for job in jobs:
+            yield play(job)
+        return
+    pool = Pool(processes or cpu_count(), _init_worker)
+    try:
+        for result in pool.imap_unordered(play, jobs, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+class Summary(object):
+    # Win counts, turns and time per (level, AI pairing)
+    def __init__(self):
+        self.groups = {}
+
+    def add(self, result):
+        group = self.groups.setdefault((result.level, result.ais),
+                {'battles': 0, 'turns': 0, 'seconds': 0.0, 'wins': {}})
+        group['battles'] += 1
+        group['turns'] += result.turns
+        group['seconds'] += result.seconds
+        winner = result.winner or 'Draw'
+        group['wins'][winner] = group['wins'].get(winner, 0) + 1
+
+    def report(self):
+        lines = []
+        for (level, ais) in sorted(self.groups):
+            group = self.groups[(level, ais)]
+            battles = group['battles']
+            wins = ', '.join(['%s %u' % (name, count)
+                    for (name, count) in sorted(group['wins'].items())])
+            lines.append('%s ai=%s battles=%u mean turns=%.1f mean time=%.4fs  %s' % (level,
+                    ','.join(ais), battles, float(group['turns']) / battles,
+                    group['seconds'] / battles, wins))
+        return '\n'.join(lines)
+
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m hexabots.batch',
+            description='Play headless AI-vs-AI battles over a process pool.')
+    parser.add_argument('levels', nargs='+', metavar='LEVEL')
+    parser.add_argument('-s', '--seeds', type=int, default=10,
+            help='battles per level and pairing, seeded 0..N-1')
+    parser.add_argument('-a', '--ai', action='append', dest='pairings',
+            help='comma-separated AI per team, e.g. nearest,nearest; may be repeated')
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('-t', '--max-turns', type=int, default=battle.MAX_TURNS)
+    parser.add_argument('-q', '--quiet', action='store_true',
+            help='only print the summary')
+    options = parser.parse_args(args)
+    pairings = [p.split(',') for p in options.pairings or ['nearest,nearest']]
+    for ais in pairings:
+        for name in ais:
+            if name not in battle.AIS:
+                parser.error('unknown AI %r, expected one of %s' % (name, ', '.join(sorted(battle.AIS))))
+    jobs = make_jobs(options.levels, range(options.seeds), pairings, options.max_turns)
+    summary = Summary()
+    start = time.time()
+    for result in run_jobs(jobs, options.processes):
+        summary.add(result)
+        if not options.quiet:
+            print result
+    print summary.report()
+    print '%u battles in %.2fs' % (len(jobs), time.time() - start)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,232 @@
+# Battle rules without rendering. Actions, turn order, cleanup, the end of
+# game check and the computer player all work on world data only, so battles
+# can be played out with no window or scene graph. play.py builds on the same
+# rules and adds animation.
+
+import sys
+from hexabots import World, HEX_DIAM, find_nearby, tile_distance_squared
+from hexabots import levelfile
+
+MOVE_RANGE = 3.5
+ATTACK_RANGE = 1.0
+ATTACK_DAMAGE = 0.2
+# CT spent choosing an attack and carrying it out
+ATTACK_PRE_COST = 0.2
+ATTACK_POST_COST = 0.2
+# Charged to a character that has nowhere to go, so it does not get the
+# next turn straight back.
+WAIT_COST = 0.5
+MAX_TURNS = 10000
+
+
+class Move(object):
+    def __init__(self, mover, tile):
+        self.mover = mover
+        self.tile = tile
+        self.path = None
+
+    def pre_cost(self):
+        return 0.0
+
+    def post_cost(self):
+        if self.path:
+            return self.path.cost / MOVE_RANGE
+        import math
+        distance = math.sqrt(tile_distance_squared(self.mover.tile, self.tile))
+        return distance / HEX_DIAM / MOVE_RANGE
+
+    def find_path(self):
+        pathfinder = self.mover.terrain.get_pathfinder()
+        self.path = pathfinder.reachable_from(self.mover, MOVE_RANGE).path_to(self.tile)
+        if not self.path:
+            self.path = pathfinder.find_path(self.mover.tile, self.tile)
+        return self.path
+
+    def do(self):
+        if self.find_path():
+            self.finish()
+
+    def finish(self):
+        self.mover.move_to(self.tile)
+
+
+class Attack(object):
+    def __init__(self, attacker, target):
+        self.attacker = attacker
+        self.target = target
+
+    def pre_cost(self):
+        return ATTACK_PRE_COST
+
+    def post_cost(self):
+        return ATTACK_POST_COST
+
+    def can_hit(self):
+        # The target may have moved or died since the attack was chosen
+        if self.target.is_dead:
+            return False
+        (attacker, target) = (self.attacker, self.target)
+        if target.tile not in find_nearby(attacker.terrain, attacker.x, attacker.y, ATTACK_RANGE):
+            return False
+        return attacker.terrain.get_sight().can_see(attacker.tile, target.tile)
+
+    def do(self):
+        if self.can_hit():
+            self.finish()
+
+    def finish(self):
+        self.target.damage(ATTACK_DAMAGE)
+
+
+class Wait(object):
+    def __init__(self, character):
+        self.character = character
+
+    def pre_cost(self):
+        return 0.0
+
+    def post_cost(self):
+        return WAIT_COST
+
+    def do(self):
+        pass
+
+
+def cleanup(world):
+    for team in world.teams:
+        for character in team.characters:
+            if not character.is_dead and character.should_die():
+                character.die()
+
+def teams_alive(world):
+    return [team for team in world.teams
+            if not all([c.is_dead for c in team.characters])]
+
+def find_opponent(teams, character):
+    least_distance = 999999999
+    closest_opponent = None
+    for team in teams:
+        if team == character.team:
+            continue
+        for other_character in team.characters:
+            if other_character.is_dead:
+                continue
+            distance = tile_distance_squared(other_character.tile, character.tile)
+            if distance < least_distance:
+                least_distance = distance
+                closest_opponent = other_character
+    return closest_opponent
+
+def choose_action(world, character):
+    # The computer player: hit the nearest opponent if it is in reach,
+    # otherwise move to the free tile in range closest to it.
+    player = find_opponent(world.teams, character)
+    attack_candidates = find_nearby(world.terrain, character.x, character.y, ATTACK_RANGE)
+    if player.tile in attack_candidates:
+        return Attack(character, player)
+    pathfinder = world.terrain.get_pathfinder()
+    shortest_distance = 10000000
+    closest_tile = None
+    for tile in pathfinder.reachable_from(character, MOVE_RANGE).tiles():
+        if tile.get_inhabitants():
+            continue
+        distance = (tile.x - player.x) ** 2 + (tile.y - player.y) ** 2
+        if distance < shortest_distance and distance > 0:
+            shortest_distance = distance
+            closest_tile = tile
+    if closest_tile is None:
+        return Wait(character)
+    return Move(character, closest_tile)
+
+def search_action(world, character):
+    from hexabots.search import choose_action
+    return choose_action(world, character)
+
+# Computer players by name, for picking one per team in batch runs
+AIS = {
+        'nearest': choose_action,
+        'search': search_action,
+}
+
+
+class Battle(object):
+    def __init__(self, world, controllers=None):
+        # controllers maps a team index to a function (world, character)
+        # returning that character's next action; other teams use
+        # choose_action.
+        self.world = world
+        self.controllers = controllers or {}
+        self.turns = 0
+        self.finished = False
+        self.winner = None
+        if world.scheduler is None:
+            world.init_scheduler()
+
+    def step(self):
+        # One turn, as play.charge and the team states play it. Returns
+        # False once the battle is over.
+        if self.finished:
+            return False
+        cleanup(self.world)
+        alive = teams_alive(self.world)
+        if len(alive) <= 1:
+            if alive:
+                self.winner = alive[0]
+            self.finished = True
+            return False
+        character = self.world.scheduler.next_actor()
+        if character is None:
+            # Nobody left standing can ever charge up again
+            self.finished = True
+            return False
+        if character.pending_action:
+            character.do_action()
+        else:
+            controller = self.controllers.get(character.team.index, choose_action)
+            character.set_action(controller(self.world, character))
+        self.turns += 1
+        return True
+
+    def checkpoint(self):
+        from hexabots.snapshot import capture
+        return (self.turns, capture(self.world))
+
+    def rollback(self, checkpoint, current=None):
+        # Returns the battle to a checkpoint. current, a later checkpoint
+        # the battle is still at, lets only what changed since be restored.
+        from hexabots.snapshot import restore
+        (self.turns, state) = checkpoint
+        restore(self.world, state, current and current[1])
+        self.finished = False
+        self.winner = None
+
+    def run(self, max_turns=MAX_TURNS):
+        # Plays until one team is left or max_turns have gone by, and
+        # returns the winning team, or None for a draw.
+        while self.turns < max_turns and self.step():
+            pass
+        return self.winner
+
+
+def load_world(filename):
+    world = World(headless=True)
+    levelfile.load_world(filename, world)
+    world.init_scheduler()
+    return world
+
+def run_battle(filename, max_turns=MAX_TURNS):
+    return Battle(load_world(filename)).run(max_turns)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print 'usage: python -m hexabots.battle LEVEL [BATTLES]'
+        sys.exit(1)
+    count = len(sys.argv) == 3 and int(sys.argv[2]) or 1
+    wins = {}
+    for i in range(count):
+        winner = run_battle(sys.argv[1])
+        name = winner and winner.name or 'Draw'
+        wins[name] = wins.get(name, 0) + 1
+    for name in sorted(wins):
+        print '%s: %u' % (name, wins[name])
@@ -0,0 +1,251 @@
+# Benchmarks for the board primitives and level I/O, run headless.
+#
+#   python -m hexabots.benchmark                      run and print
+#   python -m hexabots.benchmark -o results.json      also save the results
+#   python -m hexabots.benchmark -c baseline.json     compare with a saved run
+#
+# Each benchmark is timed at every board size as the best of a few repeats of
+# enough calls to fill min_time, and reported as seconds per call.
+
+import cPickle, json, os, platform, random, shutil, sys, tempfile, time
+from itertools import cycle, islice
+from hexabots import World, Terrain, board_coordinates, get_adjacent, find_nearby
+from hexabots import tile_distance_squared
+from hexabots import levelfile
+from hexabots.battle import find_opponent, MOVE_RANGE
+
+SIZES = [16, 160, 500, 1000]
+# Characters per team placed on the benchmark boards
+CHARACTERS = 16
+# Distinct arguments cycled through by the per-call benchmarks
+SAMPLES = 1000
+# Slowdown, as a fraction, reported as a regression by compare()
+THRESHOLD = 0.1
+
+_timer = time.clock if sys.platform == 'win32' else time.time
+
+
+def make_world(size, seed=0):
+    rng = random.Random(seed)
+    world = World(headless=True)
+    world.terrain.size_x = world.terrain.size_y = size
+    world.generate()
+    for team in world.teams:
+        for i in range(CHARACTERS - 1):
+            team.add_character(rng.randrange(size), rng.randrange(size))
+    return world
+
+def sample_coords(size, seed=0):
+    rng = random.Random(seed)
+    return [(rng.randrange(size), rng.randrange(size)) for i in range(SAMPLES)]
+
+def measure(run, min_time=0.1, repeat=3):
+    # run(n) makes n calls. Returns the best seconds per call.
+    n = 1
+    while True:
+        start = _timer()
+        run(n)
+        elapsed = _timer() - start
+        if elapsed >= min_time or n >= 1 << 24:
+            break
+        n *= 2
+    best = elapsed / n
+    for i in range(repeat - 1):
+        start = _timer()
+        run(n)
+        best = min(best, (_timer() - start) / n)
+    return (best, n)
+
+
+def bench_board_coordinates(world, coords, workdir):
+    def run(n):
+        for (x, y) in islice(cycle(coords), n):
+            board_coordinates(x, y, 0)
+    return run
+
+def bench_terrain_position(world, coords, workdir):
+    terrain = world.terrain
+    def run(n):
+        for (x, y) in islice(cycle(coords), n):
+            terrain.position(x, y)
+    return run
+
+def bench_get_adjacent(world, coords, workdir):
+    terrain = world.terrain
+    def run(n):
+        for (x, y) in islice(cycle(coords), n):
+            get_adjacent(terrain, x, y)
+    return run
+
+def bench_find_nearby(world, coords, workdir):
+    terrain = world.terrain
+    def run(n):
+        for (x, y) in islice(cycle(coords), n):
+            find_nearby(terrain, x, y, MOVE_RANGE)
+    return run
+
+def bench_tile_distance_squared(world, coords, workdir):
+    tiles = [world.terrain.tile(x, y) for (x, y) in coords]
+    pairs = zip(tiles, tiles[1:] + tiles[:1])
+    def run(n):
+        for (tile1, tile2) in islice(cycle(pairs), n):
+            tile_distance_squared(tile1, tile2)
+    return run
+
+def bench_terrain_generate(world, coords, workdir):
+    size = world.terrain.size_x
+    def run(n):
+        for i in xrange(n):
+            terrain = Terrain(world)
+            terrain.size_x = terrain.size_y = size
+            terrain.generate()
+    return run
+
+def bench_get_inhabitants(world, coords, workdir):
+    tiles = [world.terrain.tile(x, y) for (x, y) in coords]
+    def run(n):
+        for tile in islice(cycle(tiles), n):
+            tile.get_inhabitants()
+    return run
+
+def bench_find_opponent(world, coords, workdir):
+    teams = world.teams
+    characters = [c for team in teams for c in team.characters]
+    def run(n):
+        for character in islice(cycle(characters), n):
+            find_opponent(teams, character)
+    return run
+
+def bench_pickle_save(world, coords, workdir):
+    def run(n):
+        for i in xrange(n):
+            cPickle.dumps(world, True)
+    return run
+
+def bench_pickle_load(world, coords, workdir):
+    data = cPickle.dumps(world, True)
+    def run(n):
+        for i in xrange(n):
+            cPickle.loads(data)
+    return run
+
+def bench_level_save(world, coords, workdir):
+    filename = os.path.join(workdir, 'save.hxlv')
+    def run(n):
+        for i in xrange(n):
+            levelfile.save_world(world, filename)
+    return run
+
+def bench_level_load(world, coords, workdir):
+    filename = os.path.join(workdir, 'load.hxlv')
+    levelfile.save_world(world, filename)
+    def run(n):
+        for i in xrange(n):
+            levelfile.load_world(filename, World(headless=True))
+    return run
+
+BENCHMARKS = [
+        ('board_coordinates', bench_board_coordinates),
+        ('Terrain.position', bench_terrain_position),
+        ('get_adjacent', bench_get_adjacent),
+        ('find_nearby', bench_find_nearby),
+        ('tile_distance_squared', bench_tile_distance_squared),
+        ('Terrain.generate', bench_terrain_generate),
+        ('Tile.get_inhabitants', bench_get_inhabitants),
+        ('find_opponent', bench_find_opponent),
+        ('pickle_save', bench_pickle_save),
+        ('pickle_load', bench_pickle_load),
+        ('level_save', bench_level_save),
+        ('level_load', bench_level_load),
+]
+
+
+def run_benchmarks(sizes=SIZES, names=None, min_time=0.1, repeat=3, log=None):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='hexabots-bench')
+    try:
+        for size in sizes:
+            world = make_world(size)
+            coords = sample_coords(size)
+            for (name, bench) in BENCHMARKS:
+                if names and name not in names:
+                    continue
+                (seconds, calls) = measure(bench(world, coords, workdir), min_time, repeat)
+                key = '%s[%u]' % (name, size)
+                results[key] = {'name': name, 'size': size, 'seconds': seconds, 'calls': calls}
+                if log:
+                    log('%-32s %12.3f us  (%u calls)' % (key, seconds * 1e6, calls))
+    finally:
+        shutil.rmtree(workdir, True)
+    return {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+    }
+
+def compare(baseline, current, threshold=THRESHOLD):
+    # Returns (lines, regressions) comparing the benchmarks both runs share
+    lines = []
+    regressions = []
+    for key in sorted(current['results']):
+        if key not in baseline['results']:
+            continue
+        old = baseline['results'][key]['seconds']
+        new = current['results'][key]['seconds']
+        ratio = new / old if old else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        lines.append('%-32s %12.3f us -> %12.3f us  x%.2f%s' % (key, old * 1e6, new * 1e6, ratio, flag))
+    return (lines, regressions)
+
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m hexabots.benchmark',
+            description='Time the board primitives and level I/O.')
+    parser.add_argument('-s', '--sizes', default=','.join([str(s) for s in SIZES]),
+            help='comma-separated board sizes (default %(default)s)')
+    parser.add_argument('-b', '--bench', action='append', dest='names',
+            help='only run this benchmark; may be repeated')
+    parser.add_argument('-t', '--min-time', type=float, default=0.1,
+            help='seconds each repeat should last at least')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='write the results as JSON')
+    parser.add_argument('-c', '--compare', metavar='BASELINE',
+            help='compare with results saved by --output')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+            help='slowdown fraction counted as a regression (default %(default)s)')
+    options = parser.parse_args(args)
+    known = [name for (name, bench) in BENCHMARKS]
+    for name in options.names or []:
+        if name not in known:
+            parser.error('unknown benchmark %r, expected one of %s' % (name, ', '.join(known)))
+    sizes = [int(s) for s in options.sizes.split(',')]
+    def log(line):
+        print line
+        sys.stdout.flush()
+    current = run_benchmarks(sizes, options.names, options.min_time, options.repeat, log)
+    if options.output:
+        F = open(options.output, 'w')
+        json.dump(current, F, indent=1, sort_keys=True)
+        F.close()
+    if options.compare:
+        F = open(options.compare)
+        baseline = json.load(F)
+        F.close()
+        (lines, regressions) = compare(baseline, current, options.threshold)
+        print
+        print '\n'.join(lines)
+        if regressions:
+            print '%u regression(s) over %u%%' % (len(regressions), options.threshold * 100)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
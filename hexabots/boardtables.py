@@ -0,0 +1,84 @@
+# Geometry and adjacency of a board, precomputed once per board size. The
+# tables are flat arrays indexed by tile, x * size_y + y as in ArrayTerrain,
+# and are shared by every terrain with the same dimensions, so generating a
+# board or loading a level does not rebuild them.
+#
+#   neighbours   six tile indices per tile, in get_adjacent order, with
+#                OFF_BOARD for neighbours past the edge
+#   positions    board_coordinates x and y per tile
+
+import weakref
+from array import array
+from hexabots import HEX_DIAM, SQRT_3
+
+OFF_BOARD = -1
+
+# Neighbour offsets by column parity, in get_adjacent order
+NEIGHBOURS = [
+        [(-1, 0), (0, 1), (1, 0), (1, -1), (0, -1), (-1, -1)],
+        [(-1, 1), (0, 1), (1, 1), (1, 0), (0, -1), (-1, 0)],
+]
+
+# (size_x, size_y) -> BoardTables, for as long as some terrain holds them
+_cache = weakref.WeakValueDictionary()
+
+
+class BoardTables(object):
+    def __init__(self, size_x, size_y):
+        self.size_x = size_x
+        self.size_y = size_y
+        self.neighbours = self._build_neighbours()
+        self.positions = self._build_positions()
+
+    def _build_neighbours(self):
+        # Filled one direction at a time, a column at a time
+        (size_x, size_y) = (self.size_x, self.size_y)
+        neighbours = array('i', [OFF_BOARD]) * (6 * size_x * size_y)
+        for direction in range(6):
+            column = array('i')
+            for x in xrange(size_x):
+                (dx, dy) = NEIGHBOURS[x & 1][direction]
+                x2 = x + dx
+                if not 0 <= x2 < size_x:
+                    column.extend(array('i', [OFF_BOARD]) * size_y)
+                    continue
+                start = x2 * size_y + dy
+                ys = array('i', xrange(start, start + size_y))
+                if dy < 0:
+                    ys[0] = OFF_BOARD
+                elif dy > 0:
+                    ys[-1] = OFF_BOARD
+                column.extend(ys)
+            neighbours[direction::6] = column
+        return neighbours
+
+    def _build_positions(self):
+        # The same arithmetic as board_coordinates, so positions match it
+        (size_x, size_y) = (self.size_x, self.size_y)
+        columns = []
+        for parity in (0, 1):
+            columns.append(array('d', [HEX_DIAM * SQRT_3 / 2 * y + (parity * 0.5 * HEX_DIAM * SQRT_3 / 2)
+                    for y in xrange(size_y)]))
+        xs = array('d')
+        ys = array('d')
+        for x in xrange(size_x):
+            xs.extend(array('d', [0.75 * HEX_DIAM * x]) * size_y)
+            ys.extend(columns[x % 2])
+        positions = array('d', [0.0]) * (2 * size_x * size_y)
+        positions[0::2] = xs
+        positions[1::2] = ys
+        return positions
+
+    def neighbours_of(self, index):
+        return self.neighbours[6 * index:6 * index + 6]
+
+    def position(self, index):
+        return (self.positions[2 * index], self.positions[2 * index + 1])
+
+
+def get_tables(size_x, size_y):
+    tables = _cache.get((size_x, size_y))
+    if tables is None:
+        tables = BoardTables(size_x, size_y)
+        _cache[(size_x, size_y)] = tables
+    return tables
@@ -0,0 +1,140 @@
+# Editor brushes. A Stroke is one press-and-drag of a brush: applying it at
+# a tile works out the new heights or materials for the whole area at once
+# and returns them, for Terrain.set_heights and set_materials (or the edit
+# journal's equivalents) to push to the scene in one batch.
+#
+# Height brushes fade out towards the edge of their radius. Raise, lower,
+# smooth and flatten are continuous and meant to be applied every frame;
+# fill and noise are stamps, applied once per tile the stroke passes over.
+
+from hexabots import hexgrid
+from hexabots.hexgrid import EUCLIDEAN, offset_to_point
+
+RAISE = 'raise'
+LOWER = 'lower'
+SMOOTH = 'smooth'
+FLATTEN = 'flatten'
+FILL = 'fill'
+NOISE = 'noise'
+
+BRUSHES = [RAISE, LOWER, SMOOTH, FLATTEN, FILL, NOISE]
+STAMPS = [FILL, NOISE]
+
+# Height added per application at the centre of a raise or lower brush
+RAISE_STEP = 0.5
+# Fraction of the way to the target moved per application at the centre of
+# a smooth or flatten brush
+BLEND = 0.5
+# Height of the noise stamp from trough to peak, and its feature size in
+# tiles
+NOISE_AMPLITUDE = 16.0
+NOISE_SCALE = 6.0
+# Most tiles one fill changes
+FILL_LIMIT = 20000
+MIN_HEIGHT = 2
+DEFAULT_RADIUS = 5
+
+
+def brush_area(terrain, x, y, radius):
+    # [((x2, y2), weight)] for the tiles within radius, weight falling from
+    # 1 at the centre to 0 at the edge
+    (cx, cy) = offset_to_point(x, y)
+    limit = float(radius) ** 2 or 1.0
+    area = []
+    for (x2, y2) in hexgrid.coords_in_range(terrain.size_x, terrain.size_y, x, y, radius, EUCLIDEAN):
+        (px, py) = offset_to_point(x2, y2)
+        t = ((px - cx) ** 2 + (py - cy) ** 2) / limit
+        area.append(((x2, y2), (1.0 - t) ** 2))
+    return area
+
+
+class Stroke(object):
+    def __init__(self, terrain, brush, radius=DEFAULT_RADIUS, material='grass', seed=0):
+        self.terrain = terrain
+        self.brush = brush
+        self.radius = radius
+        self.material = material
+        self.seed = seed
+        # Unrounded heights built up by continuous brushes, so that small
+        # steps near the edge add up instead of rounding away
+        self.raw = {}
+        self.target = None
+        self.last = None
+
+    def is_stamp(self):
+        return self.brush in STAMPS
+
+    def apply(self, x, y):
+        # Returns (heights, materials), each mapping (x, y) to a new value
+        if self.is_stamp():
+            if self.last == (x, y):
+                return ({}, {})
+        self.last = (x, y)
+        if self.brush == FILL:
+            return ({}, self.fill(x, y))
+        area = brush_area(self.terrain, x, y, self.radius)
+        if self.brush in (RAISE, LOWER):
+            step = self.brush == RAISE and RAISE_STEP or -RAISE_STEP
+            heights = dict([(coord, self.height(coord) + step * weight) for (coord, weight) in area])
+        elif self.brush == SMOOTH:
+            heights = self.smooth(area)
+        elif self.brush == FLATTEN:
+            if self.target is None:
+                self.target = self.terrain.height_at(x, y)
+            heights = dict([(coord, self.height(coord) + BLEND * weight * (self.target - self.height(coord)))
+                    for (coord, weight) in area])
+        else:
+            heights = self.noise(area)
+        for coord in heights:
+            heights[coord] = max(MIN_HEIGHT, heights[coord])
+        if not self.is_stamp():
+            self.raw.update(heights)
+        return (heights, {})
+
+    def height(self, coord):
+        # The stroke's own unrounded height while the column still has the
+        # height the stroke last gave it
+        raw = self.raw.get(coord)
+        height = self.terrain.height_at(*coord)
+        if raw is not None and round(raw / 2.0) * 2 == height:
+            return raw
+        return height
+
+    def smooth(self, area):
+        terrain = self.terrain
+        neighbours = terrain.get_tables().neighbours
+        size_y = terrain.size_y
+        heights = {}
+        for ((x, y), weight) in area:
+            index = x * size_y + y
+            around = [terrain.height_at(*divmod(n, size_y))
+                    for n in neighbours[6 * index:6 * index + 6] if n >= 0]
+            height = self.height((x, y))
+            mean = (height + sum(around)) / (len(around) + 1)
+            heights[(x, y)] = height + BLEND * weight * (mean - height)
+        return heights
+
+    def noise(self, area):
+        from hexabots.terraingen import noise_values
+        values = noise_values([coord for (coord, weight) in area], self.seed, NOISE_SCALE, 3)
+        return dict([(coord, self.terrain.height_at(*coord) + NOISE_AMPLITUDE * (value - 0.5) * weight)
+                for ((coord, weight), value) in zip(area, values)])
+
+    def fill(self, x, y):
+        # The connected area of the clicked tile's material, repainted
+        terrain = self.terrain
+        old = terrain.material_at(x, y)
+        if old == self.material:
+            return {}
+        neighbours = terrain.get_tables().neighbours
+        size_y = terrain.size_y
+        start = x * size_y + y
+        seen = set([start])
+        todo = [start]
+        while todo and len(seen) < FILL_LIMIT:
+            index = todo.pop()
+            for n in neighbours[6 * index:6 * index + 6]:
+                if n >= 0 and n not in seen and terrain.material_at(*divmod(n, size_y)) == old:
+                    seen.add(n)
+                    todo.append(n)
+        return dict([(divmod(index, size_y), self.material) for index in seen])
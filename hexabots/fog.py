@@ -0,0 +1,173 @@
+# Fog of war. Each team sees the tiles within SIGHT_RANGE of its living
+# characters that are also in line of sight. Every tile keeps a count of the
+# team's characters that see it, so when a character moves or dies only its
+# own viewshed is recomputed and the counts adjusted; the cost of a turn
+# grows with the characters that moved, not with the board.
+#
+# One team can be the viewer. The tiles it cannot see are drawn darkened
+# through the highlight layer, and the other teams' characters on them are
+# hidden.
+
+from hexabots.hexgrid import hex_distance, max_hex_radius
+
+# Euclidean radius of a character's view in units of HEX_DIAM, as for
+# find_nearby
+SIGHT_RANGE = 6.0
+# Colour scale of tiles the viewer cannot see
+FOG_SCALE = 0.35
+
+
+class TeamView(object):
+    def __init__(self, team):
+        self.team = team
+        # (x, y) -> characters of the team that see it
+        self.counts = {}
+        # character id -> the tiles that character sees
+        self.views = {}
+
+    def sees(self, x, y):
+        return (x, y) in self.counts
+
+    def set_view(self, character_id, coords):
+        # Returns the tiles that became visible or hidden
+        changed = []
+        counts = self.counts
+        for coord in self.views.pop(character_id, ()):
+            count = counts[coord] - 1
+            if count:
+                counts[coord] = count
+            else:
+                del counts[coord]
+                changed.append(coord)
+        if coords:
+            self.views[character_id] = coords
+            for coord in coords:
+                count = counts.get(coord, 0)
+                if not count:
+                    changed.append(coord)
+                counts[coord] = count + 1
+        return changed
+
+
+class FogOfWar(object):
+    def __init__(self, world, viewer=None, sight_range=SIGHT_RANGE):
+        self.world = world
+        self.terrain = world.terrain
+        self.viewer = viewer
+        self.sight_range = sight_range
+        self.team_views = dict((team.index, TeamView(team)) for team in world.teams)
+        # Line of sight has to forget stale lines before viewsheds are redone
+        self.sight = self.terrain.get_sight()
+        self.terrain.add_height_listener(self.heights_changed)
+        self.refresh()
+        if viewer is not None:
+            self.terrain.get_highlights().fog = self
+            self.redraw_all()
+
+    def viewshed(self, character):
+        if character.is_dead:
+            return []
+        terrain = self.terrain
+        source = character.tile
+        return [(tile.x, tile.y) for tile in terrain.tiles_in_range(character.x, character.y, self.sight_range)
+                if self.sight.can_see(source, tile)]
+
+    def update(self, character):
+        # Called when a character has appeared, moved or died
+        view = self.team_views.get(character.team.index)
+        if view is None:
+            view = self.team_views[character.team.index] = TeamView(character.team)
+        changed = view.set_view(character.id, self.viewshed(character))
+        if self.viewer is not None:
+            if view.team is self.viewer:
+                self.redraw(changed)
+            else:
+                self.redraw_character(character)
+
+    def remove(self, character):
+        view = self.team_views.get(character.team.index)
+        if view is not None:
+            changed = view.set_view(character.id, None)
+            if self.viewer is not None and view.team is self.viewer:
+                self.redraw(changed)
+
+    def refresh(self):
+        # Recomputes every viewshed, e.g. after the whole board changed
+        changed = set()
+        for team in self.world.teams:
+            view = self.team_views.setdefault(team.index, TeamView(team))
+            for character in team.characters:
+                flipped = view.set_view(character.id, self.viewshed(character))
+                # Only the viewer's view is drawn
+                if team is self.viewer:
+                    changed.update(flipped)
+        if self.viewer is not None:
+            self.redraw(changed)
+            for team in self.world.teams:
+                for character in team.characters:
+                    self.redraw_character(character)
+
+    def heights_changed(self, coords):
+        if coords is None:
+            self.refresh()
+            return
+        # Only characters close enough to have a changed column in view can
+        # see differently now
+        reach = max_hex_radius(self.sight_range)
+        for team in self.world.teams:
+            for character in team.characters:
+                if character.is_dead:
+                    continue
+                for (x, y) in coords:
+                    if hex_distance(character.x, character.y, x, y) <= reach:
+                        self.update(character)
+                        break
+
+    def visible_to(self, team, x, y):
+        view = self.team_views.get(team.index)
+        return view is not None and view.sees(x, y)
+
+    def revealed(self, x, y):
+        # Whether the viewer sees a tile; everything is shown without one
+        return self.viewer is None or self.visible_to(self.viewer, x, y)
+
+    def visible_characters(self, team):
+        return [character for other in self.world.teams for character in other.characters
+                if not character.is_dead and self.visible_to(team, character.x, character.y)]
+
+    def redraw(self, coords):
+        if not coords or not self.terrain.nodePath:
+            return
+        self.terrain.get_highlights().apply(coords)
+        for coord in coords:
+            for character in self.terrain.occupants_at(*coord):
+                self.redraw_character(character)
+
+    def redraw_character(self, character):
+        if character.nodePath is None or character.team is self.viewer:
+            return
+        if self.revealed(character.x, character.y):
+            character.nodePath.show()
+        else:
+            character.nodePath.hide()
+
+    def redraw_all(self):
+        if not self.terrain.nodePath:
+            return
+        (size_x, size_y) = (self.terrain.size_x, self.terrain.size_y)
+        self.terrain.get_highlights().apply([(x, y) for x in xrange(size_x) for y in xrange(size_y)])
+        for team in self.world.teams:
+            for character in team.characters:
+                self.redraw_character(character)
+
+    def detach(self, redraw=True):
+        # Stops tracking, and unless redraw is False shows the whole board
+        # again
+        self.terrain.remove_height_listener(self.heights_changed)
+        highlights = self.terrain.get_highlights()
+        if highlights.fog is self:
+            highlights.fog = None
+        if self.viewer is not None and redraw:
+            self.viewer = None
+            self.redraw_all()
+        self.viewer = None
@@ -0,0 +1,120 @@
+# Hex grid math for the board layout used by board_coordinates: columns of
+# flat-topped hexes indexed (x, y), with odd columns shifted half a tile up.
+# Range queries work in axial coordinates (q, r) so they only visit the
+# tiles they return instead of the whole board.
+
+import math
+
+SQRT_3_2 = math.sqrt(3) / 2
+
+EUCLIDEAN = 'euclidean'
+HEX = 'hex'
+
+# Axial direction vectors, in the same order get_adjacent lists neighbours.
+AXIAL_DIRECTIONS = [(-1, 1), (0, 1), (1, 0), (1, -1), (0, -1), (-1, 0)]
+
+
+def offset_to_axial(x, y):
+    return (x, y - (x >> 1))
+
+def axial_to_offset(q, r):
+    return (q, r + (q >> 1))
+
+def axial_distance(dq, dr):
+    return max(abs(dq), abs(dr), abs(dq + dr))
+
+def hex_distance(x1, y1, x2, y2):
+    (q1, r1) = offset_to_axial(x1, y1)
+    (q2, r2) = offset_to_axial(x2, y2)
+    return axial_distance(q2 - q1, r2 - r1)
+
+def axial_norm_squared(dq, dr):
+    # Squared distance between hex centres in units of HEX_DIAM.
+    return 0.75 * (dq * dq + dq * dr + dr * dr)
+
+def max_hex_radius(distance):
+    # Every tile within a Euclidean distance (in HEX_DIAM units) is at most
+    # this many hex steps away, since centres are at least 0.75 apart per step.
+    return int(math.floor(distance / 0.75 + 1e-9))
+
+def offset_to_point(x, y):
+    # Centre of a tile in units of HEX_DIAM; board_coordinates scaled down.
+    return (0.75 * x, SQRT_3_2 * (y + (x & 1) * 0.5))
+
+def axial_round(q, r):
+    s = -q - r
+    (rq, rr, rs) = (round(q), round(r), round(s))
+    (dq, dr, ds) = (abs(rq - q), abs(rr - r), abs(rs - s))
+    if dq > dr and dq > ds:
+        rq = -rr - rs
+    elif dr > ds:
+        rr = -rq - rs
+    return (int(rq), int(rr))
+
+def point_to_axial(px, py):
+    q = px / 0.75
+    r = py / SQRT_3_2 - q / 2.0
+    return axial_round(q, r)
+
+def point_to_offset(px, py):
+    # Tile containing a point given in units of HEX_DIAM.
+    return axial_to_offset(*point_to_axial(px, py))
+
+def axial_ring(q, r, radius):
+    if radius == 0:
+        yield (q, r)
+        return
+    (dq, dr) = AXIAL_DIRECTIONS[4]
+    (q, r) = (q + dq * radius, r + dr * radius)
+    for (dq, dr) in AXIAL_DIRECTIONS:
+        for i in xrange(radius):
+            yield (q, r)
+            (q, r) = (q + dq, r + dr)
+
+def axial_spiral(q, r, radius):
+    for k in xrange(radius + 1):
+        for coord in axial_ring(q, r, k):
+            yield coord
+
+def ring(size_x, size_y, x, y, radius):
+    (q, r) = offset_to_axial(x, y)
+    coords = []
+    for (q2, r2) in axial_ring(q, r, radius):
+        (x2, y2) = axial_to_offset(q2, r2)
+        if 0 <= x2 < size_x and 0 <= y2 < size_y:
+            coords.append((x2, y2))
+    return coords
+
+def spiral(size_x, size_y, x, y, radius):
+    (q, r) = offset_to_axial(x, y)
+    coords = []
+    for (q2, r2) in axial_spiral(q, r, radius):
+        (x2, y2) = axial_to_offset(q2, r2)
+        if 0 <= x2 < size_x and 0 <= y2 < size_y:
+            coords.append((x2, y2))
+    return coords
+
+def coords_in_range(size_x, size_y, x, y, distance, metric=EUCLIDEAN):
+    # With metric=EUCLIDEAN, distance is measured between tile centres in
+    # units of HEX_DIAM, matching the original full-board scan (tiles exactly
+    # on the boundary are always included). With metric=HEX, distance is a
+    # whole number of hex steps.
+    # Coordinates come back sorted by (x, y), the order the board scan used.
+    if distance < 0:
+        return []
+    if metric == HEX:
+        coords = spiral(size_x, size_y, x, y, int(distance))
+    elif metric == EUCLIDEAN:
+        distance_squared = float(distance) ** 2
+        (q, r) = offset_to_axial(x, y)
+        coords = []
+        for (q2, r2) in axial_spiral(q, r, max_hex_radius(distance)):
+            if axial_norm_squared(q2 - q, r2 - r) > distance_squared:
+                continue
+            (x2, y2) = axial_to_offset(q2, r2)
+            if 0 <= x2 < size_x and 0 <= y2 < size_y:
+                coords.append((x2, y2))
+    else:
+        raise ValueError('unknown distance metric %r' % (metric,))
+    coords.sort()
+    return coords
@@ -0,0 +1,64 @@
+# Named sets of highlighted tiles drawn over the terrain's material colours.
+# Showing or clearing a set recolours all of its tiles in one batch, which
+# the merged terrain mesh turns into one colour upload per chunk.
+
+from pandac.PandaModules import VBase4
+from hexabots import MATERIAL_COLORS
+from hexabots.fog import FOG_SCALE
+
+# Colour scale for the tile under the mouse, as in Tile.hover
+HOVER_SCALE = 1.5
+
+
+class HighlightLayer(object):
+    def __init__(self, terrain):
+        self.terrain = terrain
+        # Set names, later ones drawn over earlier ones
+        self.order = []
+        # name -> (set of (x, y), colour)
+        self.sets = {}
+        # FogOfWar darkening the tiles its viewer cannot see
+        self.fog = None
+
+    def show(self, name, tiles, color):
+        coords = set([(tile.x, tile.y) for tile in tiles])
+        affected = set(coords)
+        if name in self.sets:
+            affected |= self.sets[name][0]
+            self.order.remove(name)
+        self.order.append(name)
+        self.sets[name] = (coords, color)
+        self.apply(affected)
+
+    def clear(self, name=None):
+        # Clears one set, or all of them
+        if name is None:
+            names = list(self.order)
+        else:
+            names = [name]
+        affected = set()
+        for name in names:
+            if name in self.sets:
+                affected |= self.sets.pop(name)[0]
+                self.order.remove(name)
+        self.apply(affected)
+
+    def color_at(self, x, y):
+        color = None
+        for name in reversed(self.order):
+            (coords, set_color) = self.sets[name]
+            if (x, y) in coords:
+                color = set_color
+                break
+        if color is None:
+            color = MATERIAL_COLORS[self.terrain.material_at(x, y)]
+        if self.fog is not None and not self.fog.revealed(x, y):
+            color = VBase4(color[0] * FOG_SCALE, color[1] * FOG_SCALE, color[2] * FOG_SCALE, color[3])
+        hovered = self.terrain.hoveredTile
+        if hovered is not None and (hovered.x, hovered.y) == (x, y):
+            color = color * HOVER_SCALE
+        return color
+
+    def apply(self, coords):
+        if coords:
+            self.terrain.set_tile_colors(dict([((x, y), self.color_at(x, y)) for (x, y) in coords]))
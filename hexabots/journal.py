@@ -0,0 +1,186 @@
+# Undo and redo for the level editor. Edits go through an EditJournal, which
+# applies them and records each one as a small delta:
+#
+#   (HEIGHT, x, y, old height, new height)
+#   (MATERIAL, x, y, old material, new material)
+#   (ADD, team index, character id, x, y)
+#   (DELETE, team index, character id, x, y, efficiency)
+#   (MOVE, team index, character id, (old x, old y), (new x, new y))
+#
+# Edits made between begin() and end(), such as a mouse drag, become one
+# entry, and repeated changes to the same tile or character in it are merged
+# into one delta. An entry costs the tiles and characters it touched, and
+# undoing or redoing it only updates those, in batches through
+# Terrain.set_heights and set_materials.
+
+HEIGHT = 'height'
+MATERIAL = 'material'
+ADD = 'add'
+DELETE = 'delete'
+MOVE = 'move'
+
+# Entries kept for undo
+MAX_ENTRIES = 200
+
+
+class EditJournal(object):
+    def __init__(self, world, limit=MAX_ENTRIES):
+        self.world = world
+        self.limit = limit
+        self.undo_entries = []
+        self.redo_entries = []
+        # The entry being recorded, and where its mergeable deltas are
+        self.entry = None
+        self.merge = {}
+        self.depth = 0
+
+    def begin(self):
+        if self.depth == 0:
+            self.entry = []
+            self.merge = {}
+        self.depth += 1
+
+    def end(self):
+        if self.depth == 0:
+            return
+        self.depth -= 1
+        if self.depth == 0:
+            entry = [delta for delta in self.entry if not self.is_noop(delta)]
+            self.entry = None
+            self.merge = {}
+            if entry:
+                self.undo_entries.append(entry)
+                del self.undo_entries[:-self.limit]
+                self.redo_entries = []
+
+    def is_noop(self, delta):
+        return delta[0] in (HEIGHT, MATERIAL, MOVE) and delta[-2] == delta[-1]
+
+    def record(self, delta, key=None):
+        # key names what a delta changes, so that a later change to the same
+        # thing in this entry only updates its new value
+        self.begin()
+        if key is not None and key in self.merge:
+            i = self.merge[key]
+            self.entry[i] = self.entry[i][:-1] + delta[-1:]
+        else:
+            if key is not None:
+                self.merge[key] = len(self.entry)
+            self.entry.append(delta)
+        self.end()
+
+    # Edits
+
+    def set_height(self, tile, height):
+        self.set_heights({(tile.x, tile.y): height})
+
+    def change_material(self, tile, material):
+        self.set_materials({(tile.x, tile.y): material})
+
+    def set_heights(self, heights):
+        # heights maps (x, y) to a new height, as for Terrain.set_heights
+        terrain = self.world.terrain
+        old = dict([(coord, terrain.height_at(*coord)) for coord in heights])
+        self.begin()
+        for (x, y) in terrain.set_heights(heights):
+            self.record((HEIGHT, x, y, old[(x, y)], terrain.height_at(x, y)), (HEIGHT, x, y))
+        self.end()
+
+    def set_materials(self, materials):
+        terrain = self.world.terrain
+        old = dict([(coord, terrain.material_at(*coord)) for coord in materials])
+        self.begin()
+        for (x, y) in terrain.set_materials(materials):
+            self.record((MATERIAL, x, y, old[(x, y)], materials[(x, y)]), (MATERIAL, x, y))
+        self.end()
+
+    def add_character(self, team_index, x, y):
+        character = self._add(team_index, None, x, y)
+        self.merge.pop((MOVE, team_index, character.id), None)
+        self.record((ADD, team_index, character.id, x, y))
+        return character
+
+    def delete_character(self, character):
+        (team_index, character_id) = (character.team.index, character.id)
+        self.merge.pop((MOVE, team_index, character_id), None)
+        self.record((DELETE, team_index, character_id, character.x, character.y,
+                character.efficiency))
+        self.world.teams[team_index].delete_character(character_id)
+
+    def move_character(self, character, tile):
+        old = (character.x, character.y)
+        character.move_to(tile)
+        key = (MOVE, character.team.index, character.id)
+        self.record((MOVE, character.team.index, character.id, old, (tile.x, tile.y)), key)
+
+    # Replaying deltas
+
+    def _add(self, team_index, character_id, x, y, efficiency=None):
+        character = self.world.teams[team_index].add_character(x, y, character_id)
+        if efficiency is not None:
+            character.efficiency = efficiency
+        if self.world.nodePath:
+            character.init_nodepath()
+        return character
+
+    def _character(self, team_index, character_id):
+        return self.world.teams[team_index].characters_dict[character_id]
+
+    def replay(self, deltas, forward):
+        # Runs of tile changes are applied a batch at a time; each tile
+        # appears at most once in an entry, so a batch keeps the order.
+        heights = {}
+        materials = {}
+        for delta in deltas:
+            kind = delta[0]
+            if kind == HEIGHT:
+                heights[(delta[1], delta[2])] = delta[forward and 4 or 3]
+            elif kind == MATERIAL:
+                materials[(delta[1], delta[2])] = delta[forward and 4 or 3]
+            else:
+                self.flush(heights, materials)
+                self.apply(delta, forward)
+        self.flush(heights, materials)
+
+    def flush(self, heights, materials):
+        if heights:
+            self.world.terrain.set_heights(heights)
+            heights.clear()
+        if materials:
+            self.world.terrain.set_materials(materials)
+            materials.clear()
+
+    def apply(self, delta, forward):
+        kind = delta[0]
+        if kind == MOVE:
+            (x, y) = delta[forward and 4 or 3]
+            self._character(delta[1], delta[2]).move_to(self.world.terrain.tile(x, y))
+        elif (kind == ADD) == forward:
+            self._add(*delta[1:])
+        else:
+            self.world.teams[delta[1]].delete_character(delta[2])
+
+    def can_undo(self):
+        return not self.depth and bool(self.undo_entries)
+
+    def can_redo(self):
+        return not self.depth and bool(self.redo_entries)
+
+    def undo(self):
+        # Returns whether anything was undone. Nothing is while an entry is
+        # open, e.g. during a drag, which would otherwise redo its edit on
+        # the next frame.
+        if self.depth or not self.undo_entries:
+            return False
+        entry = self.undo_entries.pop()
+        self.replay(reversed(entry), False)
+        self.redo_entries.append(entry)
+        return True
+
+    def redo(self):
+        if self.depth or not self.redo_entries:
+            return False
+        entry = self.redo_entries.pop()
+        self.replay(entry, True)
+        self.undo_entries.append(entry)
+        return True
@@ -0,0 +1,198 @@
+# Binary level format.
+#
+#   header      magic, version, board size and table counts
+#   materials   material names, in id order
+#   heights     float32 per tile, x-major (x * size_y + y)
+#   materials   uint8 material id per tile, padded to 4 bytes
+#   teams       index, colour and name per team
+#   characters  team, id, position, efficiency and is_dead per character
+#
+# Everything is little-endian. Loading maps the file and copies the two tile
+# arrays straight into an ArrayTerrain, without creating per-tile objects.
+# Older pickled levels can be read and converted with convert().
+
+import cPickle, mmap, random, struct, sys
+from array import array
+from hexabots import Team
+from hexabots.arrayterrain import ArrayTerrain, MATERIALS, MATERIAL_IDS
+
+MAGIC = 'HXLV'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIII')
+MATERIAL_NAME = struct.Struct('<16s')
+TEAM = struct.Struct('<H4f32s')
+CHARACTER = struct.Struct('<HHIIfB')
+
+
+class Level(object):
+    def __init__(self, size_x, size_y):
+        self.size_x = size_x
+        self.size_y = size_y
+        self.heights = array('f')
+        self.materials = array('B')
+        # (index, name, color) per team and
+        # (team_index, id, x, y, efficiency, is_dead) per character
+        self.teams = []
+        self.characters = []
+
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+def _padding(length):
+    return '\0' * (-length % 4)
+
+def write_level(level, filename):
+    F = open(filename, 'wb')
+    F.write(HEADER.pack(MAGIC, VERSION, len(MATERIALS), level.size_x, level.size_y,
+            len(level.teams), len(level.characters)))
+    for name in MATERIALS:
+        F.write(MATERIAL_NAME.pack(name))
+    F.write(_little_endian(level.heights).tostring())
+    F.write(level.materials.tostring())
+    F.write(_padding(len(level.materials)))
+    for (index, name, color) in level.teams:
+        F.write(TEAM.pack(index, color[0], color[1], color[2], color[3], name.encode('utf-8')))
+    for (team_index, id, x, y, efficiency, is_dead) in level.characters:
+        F.write(CHARACTER.pack(team_index, id, x, y, efficiency, is_dead))
+    F.close()
+
+def is_level_file(filename):
+    F = open(filename, 'rb')
+    magic = F.read(len(MAGIC))
+    F.close()
+    return magic == MAGIC
+
+def read_level(filename):
+    F = open(filename, 'rb')
+    data = mmap.mmap(F.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        (magic, version, material_count, size_x, size_y, team_count,
+                character_count) = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a level file' % (filename,))
+        if version > VERSION:
+            raise ValueError('%s has level format version %u, newer than %u'
+                    % (filename, version, VERSION))
+        offset = HEADER.size
+        names = []
+        for i in range(material_count):
+            (name,) = MATERIAL_NAME.unpack_from(data, offset)
+            names.append(name.rstrip('\0'))
+            offset += MATERIAL_NAME.size
+        level = Level(size_x, size_y)
+        count = size_x * size_y
+        level.heights.fromstring(data[offset:offset + 4 * count])
+        level.heights = _little_endian(level.heights)
+        offset += 4 * count
+        level.materials.fromstring(data[offset:offset + count])
+        offset += count + len(_padding(count))
+        if names != MATERIALS:
+            remap = array('B', [MATERIAL_IDS[name] for name in names])
+            level.materials = array('B', [remap[i] for i in level.materials])
+        for i in range(team_count):
+            (index, r, g, b, a, name) = TEAM.unpack_from(data, offset)
+            level.teams.append((index, name.rstrip('\0').decode('utf-8'), (r, g, b, a)))
+            offset += TEAM.size
+        for i in range(character_count):
+            level.characters.append(CHARACTER.unpack_from(data, offset))
+            offset += CHARACTER.size
+    finally:
+        data.close()
+        F.close()
+    return level
+
+def _fill_level(level, terrain, teams):
+    if getattr(terrain, 'heights', None) is not None:
+        # ArrayTerrain, or the raw bytes it pickles its arrays as
+        level.heights = array('f', terrain.heights)
+        level.materials = array('B', terrain.materials)
+    else:
+        for row in terrain.rows:
+            for tile in row:
+                level.heights.append(tile.height)
+                level.materials.append(MATERIAL_IDS[tile.material])
+    for team in teams:
+        level.teams.append((team.index, team.name, tuple(team.color)))
+        for character in team.characters:
+            level.characters.append((team.index, character.id, character.x,
+                    character.y, character.efficiency, character.is_dead))
+    return level
+
+def level_from_world(world):
+    terrain = world.terrain
+    return _fill_level(Level(terrain.size_x, terrain.size_y), terrain, world.teams)
+
+def build_world(level, world):
+    # Fill a freshly made World from a Level. Nodepaths are left to the caller.
+    world.init_terrain(ArrayTerrain)
+    terrain = world.terrain
+    (terrain.size_x, terrain.size_y) = (level.size_x, level.size_y)
+    terrain.heights = level.heights
+    terrain.materials = level.materials
+    world.teams = []
+    for (index, name, color) in level.teams:
+        world.teams.append(Team(world, index, name, color))
+    for (team_index, id, x, y, efficiency, is_dead) in level.characters:
+        character = world.teams[team_index].add_character(x, y, id)
+        character.efficiency = efficiency
+        # Unpickled characters always started with a random CT
+        character.CT = random.random()
+        if is_dead:
+            character.is_dead = True
+            terrain.remove_occupant(character)
+    return world
+
+def save_world(world, filename):
+    write_level(level_from_world(world), filename)
+
+def read_any_level(filename):
+    if is_level_file(filename):
+        return read_level(filename)
+    return read_pickled_level(filename)
+
+def load_world(filename, world):
+    return build_world(read_any_level(filename), world)
+
+
+class _Record:
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+class _NewRecord(object):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+def _find_global(module, name):
+    __import__(module)
+    found = getattr(sys.modules[module], name)
+    if module.split('.')[0] != 'hexabots':
+        return found
+    # Stand-ins so that unpickling does not build any nodepaths
+    if isinstance(found, type):
+        return _NewRecord
+    return _Record
+
+def read_pickled_level(filename):
+    F = open(filename, 'rb')
+    unpickler = cPickle.Unpickler(F)
+    unpickler.find_global = _find_global
+    world = unpickler.load()
+    F.close()
+    terrain = world.terrain
+    return _fill_level(Level(terrain.size_x, terrain.size_y), terrain, world.teams)
+
+def convert(pickle_filename, level_filename):
+    write_level(read_pickled_level(pickle_filename), level_filename)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print 'usage: python -m hexabots.levelfile OLD_PICKLE NEW_LEVEL'
+        sys.exit(1)
+    convert(sys.argv[1], sys.argv[2])
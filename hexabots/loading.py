@@ -0,0 +1,100 @@
+# Loads a level without freezing the window: the file is parsed on a worker
+# thread, then the scene graph is built a little at a time on each frame
+# while a progress bar is shown. WorldGenerator does the same for a noise
+# map, whose fields are computed on the worker thread.
+
+from direct.showbase.DirectObject import DirectObject
+from direct.gui.DirectGui import DirectWaitBar
+from direct.stdpy import threading
+from hexabots import World, BOARD_X, BOARD_Y
+from hexabots import levelfile
+from hexabots.arrayterrain import ArrayTerrain
+from hexabots.profiling import timed
+
+
+class WorldLoader(DirectObject):
+    # Seconds of scene building allowed per frame
+    frame_budget = 0.01
+
+    def __init__(self, filename, on_done):
+        self.filename = filename
+        self.start(on_done, 'Loading %s' % (filename,))
+
+    def start(self, on_done, text):
+        self.on_done = on_done
+        self.level = None
+        self.error = None
+        self.world = None
+        self.steps = None
+        self.bar = DirectWaitBar(text=text, value=0,
+                range=100, scale=0.5, pos=(0, 0, -0.6))
+        self.thread = threading.Thread(target=self.parse)
+        self.thread.start()
+        taskMgr.add(self.load_task, 'loadWorld')
+
+    def parse(self):
+        try:
+            self.level = self.read()
+        except Exception, e:
+            self.error = e
+
+    def read(self):
+        # Runs on the worker thread
+        return levelfile.read_any_level(self.filename)
+
+    def make_world(self):
+        world = World()
+        levelfile.build_world(self.level, world)
+        return world
+
+    @timed('WorldLoader.load_task')
+    def load_task(self, task):
+        if self.thread.isAlive():
+            return task.cont
+        if self.error:
+            print 'Could not load %s: %s' % (self.filename, self.error)
+            self.finish(None)
+            return task.done
+        if self.steps is None:
+            self.world = self.make_world()
+            self.steps = self.world.build_nodepath()
+        deadline = globalClock.getRealTime() + self.frame_budget
+        for progress in self.steps:
+            self.bar['value'] = progress * 100
+            if globalClock.getRealTime() > deadline:
+                return task.cont
+        self.finish(self.world)
+        return task.done
+
+    def finish(self, world):
+        self.bar.destroy()
+        self.on_done(world)
+
+    def cancel(self):
+        taskMgr.remove('loadWorld')
+        self.bar.destroy()
+        if self.world:
+            self.world.clear()
+
+
+class WorldGenerator(WorldLoader):
+    def __init__(self, seed, on_done, size_x=BOARD_X, size_y=BOARD_Y, **params):
+        # params are passed on to terraingen.generate_fields
+        self.filename = 'seed %u' % (seed,)
+        self.seed = seed
+        (self.size_x, self.size_y) = (size_x, size_y)
+        self.params = params
+        self.start(on_done, 'Generating a %ux%u map' % (size_x, size_y))
+
+    def read(self):
+        from hexabots.terraingen import generate_fields
+        return generate_fields(self.size_x, self.size_y, self.seed, **self.params)
+
+    def make_world(self):
+        world = World(ArrayTerrain)
+        terrain = world.terrain
+        (terrain.size_x, terrain.size_y) = (self.size_x, self.size_y)
+        world.generate()
+        (terrain.heights, terrain.materials) = self.level
+        terrain.heights_changed()
+        return world
@@ -0,0 +1,242 @@
+# Pathfinding over the hex board. Costs are in units of HEX_DIAM, so a step
+# between flat grass tiles costs the distance between their centres, the
+# same scale Move.post_cost has always used.
+
+import heapq, math
+from array import array
+from hexabots.hexgrid import hex_distance
+
+STEP = math.sqrt(3) / 2
+
+DEFAULT_MATERIAL_COSTS = {
+        'grass': 1.0,
+        'stone': 1.0,
+        'water': 2.0,
+}
+
+
+class MoveCosts(object):
+    def __init__(self, materials=None, climb=0.05, descend=0.0, max_climb=None):
+        # materials multiplies the step cost per material; a material missing
+        # from it, or mapped to None, cannot be entered. climb and descend are
+        # added per unit of height changed, and steps up by more than
+        # max_climb are not allowed.
+        if materials is None:
+            materials = DEFAULT_MATERIAL_COSTS
+        self.materials = materials
+        self.climb = climb
+        self.descend = descend
+        self.max_climb = max_climb
+
+    def step_cost(self, from_height, to_height, to_material):
+        factor = self.materials.get(to_material)
+        if factor is None:
+            return None
+        rise = to_height - from_height
+        if self.max_climb is not None and rise > self.max_climb:
+            return None
+        if rise > 0:
+            return STEP * factor + rise * self.climb
+        return STEP * factor - rise * self.descend
+
+    def min_step_cost(self):
+        factors = [f for f in self.materials.values() if f is not None]
+        return STEP * min(factors or [1.0])
+
+DEFAULT_COSTS = MoveCosts()
+
+
+class SearchBuffers(object):
+    # Per-tile scratch space for one search. Entries are only valid when
+    # their stamp matches the current generation, so nothing is cleared or
+    # reallocated between queries.
+    def __init__(self, size):
+        self.size = size
+        self.generation = 0
+        self.cost = array('d', [0.0]) * size
+        self.parent = array('i', [-1]) * size
+        self.seen = array('L', [0]) * size
+        self.closed = array('L', [0]) * size
+        self.heap = []
+
+    def reset(self):
+        self.generation += 1
+        del self.heap[:]
+        return self.generation
+
+
+class BufferPool(object):
+    def __init__(self):
+        self.free = {}
+
+    def acquire(self, size):
+        buffers = self.free.get(size)
+        if buffers:
+            return buffers.pop()
+        return SearchBuffers(size)
+
+    def release(self, buffers):
+        self.free.setdefault(buffers.size, []).append(buffers)
+
+pool = BufferPool()
+
+
+class Path(object):
+    def __init__(self, tiles, cost):
+        self.tiles = tiles
+        self.cost = cost
+
+    def __len__(self):
+        return len(self.tiles)
+
+
+class Reachability(object):
+    # Result of flooding a movement budget out from a tile: the cost of the
+    # cheapest route to each reachable tile and the tile it came from.
+    def __init__(self, terrain, start, budget, costs, parents):
+        self.terrain = terrain
+        self.start = start
+        self.budget = budget
+        self.costs = costs
+        self.parents = parents
+
+    def __contains__(self, tile):
+        return (tile.x, tile.y) in self.costs
+
+    def tiles(self):
+        return [self.terrain.tile(x, y) for (x, y) in sorted(self.costs)]
+
+    def cost_to(self, tile):
+        return self.costs.get((tile.x, tile.y))
+
+    def path_to(self, tile):
+        coord = (tile.x, tile.y)
+        if coord not in self.costs:
+            return None
+        tiles = []
+        while coord is not None:
+            tiles.append(self.terrain.tile(*coord))
+            coord = self.parents[coord]
+        tiles.reverse()
+        return Path(tiles, self.costs[(tile.x, tile.y)])
+
+
+class PathFinder(object):
+    def __init__(self, terrain, costs=DEFAULT_COSTS):
+        self.terrain = terrain
+        self.costs = costs
+        # (team index, character id) -> (cache key, Reachability)
+        self.reach_cache = {}
+
+    def neighbours(self, x, y):
+        size_y = self.terrain.size_y
+        for index in self.terrain.get_tables().neighbours_of(x * size_y + y):
+            if index >= 0:
+                yield divmod(index, size_y)
+
+    def step_cost(self, x, y, x2, y2):
+        terrain = self.terrain
+        return self.costs.step_cost(terrain.height_at(x, y), terrain.height_at(x2, y2),
+                terrain.material_at(x2, y2))
+
+    def is_blocked(self, x, y):
+        return bool(self.terrain.occupants.get((x, y)))
+
+    def _path(self, buffers, goal):
+        size_y = self.terrain.size_y
+        tiles = []
+        index = goal
+        while index != -1:
+            tiles.append(self.terrain.tile(index // size_y, index % size_y))
+            index = buffers.parent[index]
+        tiles.reverse()
+        return Path(tiles, buffers.cost[goal])
+
+    def find_path(self, start, goal):
+        # A* from one tile to another, around occupied tiles. Returns a Path
+        # whose tiles run from start to goal, or None.
+        if self.is_blocked(goal.x, goal.y) and goal != start:
+            return None
+        size_y = self.terrain.size_y
+        buffers = pool.acquire(self.terrain.size_x * size_y)
+        try:
+            generation = buffers.reset()
+            (cost, parent, seen, closed, heap) = (buffers.cost, buffers.parent,
+                    buffers.seen, buffers.closed, buffers.heap)
+            min_step = self.costs.min_step_cost()
+            neighbours = self.terrain.get_tables().neighbours
+            goal_index = goal.x * size_y + goal.y
+            start_index = start.x * size_y + start.y
+            cost[start_index] = 0.0
+            parent[start_index] = -1
+            seen[start_index] = generation
+            heap.append((hex_distance(start.x, start.y, goal.x, goal.y) * min_step, start_index))
+            while heap:
+                (priority, index) = heapq.heappop(heap)
+                if closed[index] == generation:
+                    continue
+                if index == goal_index:
+                    return self._path(buffers, goal_index)
+                closed[index] = generation
+                (x, y) = divmod(index, size_y)
+                for index2 in neighbours[6 * index:6 * index + 6]:
+                    if index2 < 0 or closed[index2] == generation:
+                        continue
+                    (x2, y2) = divmod(index2, size_y)
+                    if index2 != goal_index and self.is_blocked(x2, y2):
+                        continue
+                    step = self.step_cost(x, y, x2, y2)
+                    if step is None:
+                        continue
+                    new_cost = cost[index] + step
+                    if seen[index2] == generation and new_cost >= cost[index2]:
+                        continue
+                    seen[index2] = generation
+                    cost[index2] = new_cost
+                    parent[index2] = index
+                    estimate = hex_distance(x2, y2, goal.x, goal.y) * min_step
+                    heapq.heappush(heap, (new_cost + estimate, index2))
+            return None
+        finally:
+            pool.release(buffers)
+
+    def reachable(self, start, budget, blocked=None):
+        # Dijkstra flood from start over every tile whose cheapest route
+        # costs no more than budget, not passing through occupied tiles, or
+        # through the (x, y) in blocked when it is given.
+        costs = {(start.x, start.y): 0.0}
+        parents = {(start.x, start.y): None}
+        heap = [(0.0, start.x, start.y)]
+        done = set()
+        while heap:
+            (cost, x, y) = heapq.heappop(heap)
+            if (x, y) in done:
+                continue
+            done.add((x, y))
+            for (x2, y2) in self.neighbours(x, y):
+                if (x2, y2) in done:
+                    continue
+                if blocked is None and self.is_blocked(x2, y2) or blocked and (x2, y2) in blocked:
+                    continue
+                step = self.step_cost(x, y, x2, y2)
+                if step is None:
+                    continue
+                new_cost = cost + step
+                if new_cost > budget or new_cost >= costs.get((x2, y2), budget + 1):
+                    continue
+                costs[(x2, y2)] = new_cost
+                parents[(x2, y2)] = (x, y)
+                heapq.heappush(heap, (new_cost, x2, y2))
+        return Reachability(self.terrain, start, budget, costs, parents)
+
+    def reachable_from(self, character, budget):
+        # Cached per character, position and terrain version, so that range
+        # highlighting, the AI and Move all share one flood per turn.
+        key = (character.x, character.y, self.terrain.version, budget)
+        owner = (character.team.index, character.id)
+        cached = self.reach_cache.get(owner)
+        if cached and cached[0] == key:
+            return cached[1]
+        result = self.reachable(character.tile, budget)
+        self.reach_cache[owner] = (key, result)
+        return result
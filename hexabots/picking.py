@@ -0,0 +1,135 @@
+# Analytic mouse picking. The camera ray is walked across the board one hex
+# cell at a time (a hex DDA) and tested against each column's height and the
+# characters standing on it, so the cost depends on how far the ray travels
+# rather than on how many tiles or nodes the terrain has. The walk only
+# covers the stretch of the ray between the ground and the top of the
+# tallest column, so a tilted camera skips the cells it passes high above.
+
+import math
+from hexabots import HEX_DIAM
+from hexabots.hexgrid import axial_to_offset, offset_to_axial, offset_to_point, point_to_offset
+
+# Rough bounds of the character model, as a cylinder standing on the tile
+CHARACTER_RADIUS = 0.3 * HEX_DIAM
+CHARACTER_HEIGHT = HEX_DIAM
+
+HEX_RADIUS = HEX_DIAM / 2.0
+APOTHEM = HEX_RADIUS * math.sqrt(3) / 2
+# Outward normal of each hex edge and the axial step to the tile across it
+EDGES = []
+for i, step in enumerate([(1, 0), (0, 1), (-1, 1), (-1, 0), (0, -1), (1, -1)]):
+    angle = math.radians(60 * i + 30)
+    EDGES.append((math.cos(angle), math.sin(angle), step))
+
+
+def _clip_to_board(terrain, origin, direction):
+    # Parameter range over which the ray's XY projection crosses the board's
+    # bounding box (padded by a hex radius), or None if it never does.
+    (t0, t1) = (0.0, 1.0)
+    (x_max, y_max) = offset_to_point(terrain.size_x - 1, terrain.size_y)
+    bounds = [(-HEX_RADIUS, x_max * HEX_DIAM + HEX_RADIUS), (-HEX_RADIUS, y_max * HEX_DIAM + HEX_RADIUS)]
+    for axis in range(2):
+        (lo, hi) = bounds[axis]
+        if abs(direction[axis]) < 1e-12:
+            if not lo <= origin[axis] <= hi:
+                return None
+            continue
+        ta = (lo - origin[axis]) / direction[axis]
+        tb = (hi - origin[axis]) / direction[axis]
+        (t0, t1) = (max(t0, min(ta, tb)), min(t1, max(ta, tb)))
+        if t0 > t1:
+            return None
+    return (t0, t1)
+
+def _clip_to_heights(terrain, origin, direction, t0, t1):
+    # Narrows [t0, t1] to where the ray is between the ground and the top of
+    # a character on the tallest column, or None if it never is.
+    (low, high) = (0.0, terrain.max_height() + CHARACTER_HEIGHT)
+    dz = direction[2]
+    if abs(dz) < 1e-12:
+        if not low <= origin[2] <= high:
+            return None
+        return (t0, t1)
+    ta = (low - origin[2]) / dz
+    tb = (high - origin[2]) / dz
+    (t0, t1) = (max(t0, min(ta, tb)), min(t1, max(ta, tb)))
+    if t0 > t1:
+        return None
+    return (t0, t1)
+
+def _exit_parameter(center, origin, direction):
+    best = None
+    for (nx, ny, step) in EDGES:
+        facing = nx * direction[0] + ny * direction[1]
+        if facing <= 1e-12:
+            continue
+        offset = nx * (origin[0] - center[0]) + ny * (origin[1] - center[1])
+        t = (APOTHEM - offset) / facing
+        if best is None or t < best[0]:
+            best = (t, step)
+    return best
+
+def _hits_character(center, height, origin, direction, t0, t1):
+    # Ray against a vertical cylinder standing on the column, within [t0, t1]
+    (ox, oy) = (origin[0] - center[0], origin[1] - center[1])
+    (dx, dy) = (direction[0], direction[1])
+    a = dx * dx + dy * dy
+    b = 2 * (ox * dx + oy * dy)
+    c = ox * ox + oy * oy - CHARACTER_RADIUS ** 2
+    if a < 1e-12:
+        if c > 0:
+            return False
+    else:
+        discriminant = b * b - 4 * a * c
+        if discriminant < 0:
+            return False
+        root = math.sqrt(discriminant)
+        t0 = max(t0, (-b - root) / (2 * a))
+        t1 = min(t1, (-b + root) / (2 * a))
+    dz = direction[2]
+    (z_low, z_high) = (height, height + CHARACTER_HEIGHT)
+    if abs(dz) < 1e-12:
+        if not z_low <= origin[2] <= z_high:
+            return False
+    else:
+        ta = (z_low - origin[2]) / dz
+        tb = (z_high - origin[2]) / dz
+        t0 = max(t0, min(ta, tb))
+        t1 = min(t1, max(ta, tb))
+    return t0 <= t1
+
+def pick(terrain, near, far):
+    # near and far are the ends of the camera ray in terrain space. Returns
+    # the first character or tile the ray meets, or None.
+    origin = tuple(near)
+    direction = tuple(f - n for (f, n) in zip(far, near))
+    clipped = _clip_to_board(terrain, origin, direction)
+    if clipped is not None:
+        clipped = _clip_to_heights(terrain, origin, direction, *clipped)
+    if clipped is None:
+        return None
+    (t, t_end) = clipped
+    start = [o + t * d for (o, d) in zip(origin, direction)]
+    (x, y) = point_to_offset(start[0] / HEX_DIAM, start[1] / HEX_DIAM)
+    (q, r) = offset_to_axial(x, y)
+    while t <= t_end:
+        (x, y) = axial_to_offset(q, r)
+        (px, py) = offset_to_point(x, y)
+        center = (px * HEX_DIAM, py * HEX_DIAM)
+        crossing = _exit_parameter(center, origin, direction)
+        t_exit = t_end if crossing is None else min(crossing[0], t_end)
+        if 0 <= x < terrain.size_x and 0 <= y < terrain.size_y:
+            height = terrain.tile(x, y).height
+            for character in terrain.occupants_at(x, y):
+                if _hits_character(center, height, origin, direction, t, t_exit):
+                    return character
+            z_enter = origin[2] + t * direction[2]
+            z_exit = origin[2] + t_exit * direction[2]
+            if min(z_enter, z_exit) <= height:
+                return terrain.tile(x, y)
+        if crossing is None:
+            break
+        (dq, dr) = crossing[1]
+        (q, r) = (q + dq, r + dr)
+        t = max(t, crossing[0])
+    return None
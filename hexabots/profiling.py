@@ -0,0 +1,191 @@
+# Per-frame profiling. Functions wrapped with timed() add their time to the
+# current frame's breakdown while the profiler is enabled; while it is
+# disabled the wrapper costs one attribute check. Frames are delimited by a
+# task that runs before everything else, and rendering is timed by a pair of
+# tasks either side of ShowBase's igLoop (sort 50).
+#
+# F3 toggles profiling with the overlay and F4 writes the recorded frames as
+# JSON and CSV, in apps that call install_keys().
+
+import csv, json, math, time
+from collections import deque
+from timeit import default_timer
+
+# Frames kept for percentiles, the overlay and exports
+HISTORY = 600
+PERCENTILES = (50, 95, 99)
+# Seconds between overlay refreshes
+HUD_INTERVAL = 0.25
+
+
+class Profiler(object):
+    def __init__(self, history=HISTORY):
+        self.enabled = False
+        self.frames = deque(maxlen=history)
+        self.frame_count = 0
+        self.frame_start = None
+        self.render_start = None
+        # Seconds per section in the current frame, and the part of the frame
+        # covered by outermost sections
+        self.sections = {}
+        self.tracked = 0.0
+        self.depth = 0
+        self.hud = None
+        self.hud_updated = 0.0
+
+    def enable(self, hud=False):
+        if not self.enabled:
+            self.enabled = True
+            self.frame_start = None
+            self.sections = {}
+            self.tracked = 0.0
+            taskMgr.add(self.frame_task, 'profileFrame', sort=-1000)
+            taskMgr.add(self.render_start_task, 'profileRenderStart', sort=49)
+            taskMgr.add(self.render_end_task, 'profileRenderEnd', sort=51)
+        if hud:
+            self.show_hud()
+
+    def disable(self):
+        if self.enabled:
+            self.enabled = False
+            taskMgr.remove('profileFrame')
+            taskMgr.remove('profileRenderStart')
+            taskMgr.remove('profileRenderEnd')
+        self.hide_hud()
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable(hud=True)
+
+    def record(self, name, elapsed):
+        self.sections[name] = self.sections.get(name, 0.0) + elapsed
+        if self.depth == 0:
+            self.tracked += elapsed
+
+    def frame_task(self, task):
+        now = default_timer()
+        if self.frame_start is not None:
+            self.end_frame(now)
+        self.frame_start = now
+        self.sections = {}
+        self.tracked = 0.0
+        return task.cont
+
+    def render_start_task(self, task):
+        self.render_start = default_timer()
+        return task.cont
+
+    def render_end_task(self, task):
+        if self.render_start is not None:
+            self.record('render', default_timer() - self.render_start)
+            self.render_start = None
+        return task.cont
+
+    def end_frame(self, now):
+        total = now - self.frame_start
+        self.frames.append({
+                'frame': self.frame_count,
+                'start': self.frame_start,
+                'total': total,
+                'untracked': max(0.0, total - self.tracked),
+                'sections': self.sections,
+        })
+        self.frame_count += 1
+        if self.hud and now - self.hud_updated >= HUD_INTERVAL:
+            self.hud_updated = now
+            self.hud.setText(self.summary())
+
+    def percentiles(self, points=PERCENTILES):
+        # Nearest-rank percentiles of the recorded frame times
+        times = sorted([frame['total'] for frame in self.frames])
+        result = {}
+        for p in points:
+            if times:
+                rank = int(math.ceil(p / 100.0 * len(times)))
+                result[p] = times[max(0, min(len(times), rank) - 1)]
+            else:
+                result[p] = 0.0
+        return result
+
+    def section_means(self):
+        # Mean seconds per frame spent in each section over the history
+        totals = {'untracked': 0.0}
+        for frame in self.frames:
+            totals['untracked'] += frame['untracked']
+            for (name, elapsed) in frame['sections'].items():
+                totals[name] = totals.get(name, 0.0) + elapsed
+        count = max(1, len(self.frames))
+        return dict((name, total / count) for (name, total) in totals.items())
+
+    def summary(self):
+        percentiles = self.percentiles()
+        lines = ['frame  ' + '  '.join(['p%u %.1f ms' % (p, percentiles[p] * 1000)
+                for p in sorted(percentiles)])]
+        means = self.section_means()
+        for name in sorted(means, key=means.get, reverse=True):
+            lines.append('%-20s %6.2f ms' % (name, means[name] * 1000))
+        return '\n'.join(lines)
+
+    def show_hud(self):
+        if self.hud is None:
+            from direct.gui.OnscreenText import OnscreenText
+            from pandac.PandaModules import TextNode
+            self.hud = OnscreenText(text='', pos=(-1.3, 0.95), scale=0.04,
+                    fg=(1.0, 1.0, 1.0, 1.0), align=TextNode.ALeft, mayChange=True)
+            self.hud_updated = 0.0
+
+    def hide_hud(self):
+        if self.hud:
+            self.hud.destroy()
+            self.hud = None
+
+    def export_json(self, filename):
+        F = open(filename, 'w')
+        json.dump({'percentiles': self.percentiles(), 'frames': list(self.frames)}, F, indent=1)
+        F.close()
+
+    def export_csv(self, filename):
+        names = set()
+        for frame in self.frames:
+            names.update(frame['sections'])
+        names = sorted(names)
+        F = open(filename, 'wb')
+        writer = csv.writer(F)
+        writer.writerow(['frame', 'start', 'total', 'untracked'] + names)
+        for frame in self.frames:
+            writer.writerow([frame['frame'], frame['start'], frame['total'], frame['untracked']]
+                    + [frame['sections'].get(name, 0.0) for name in names])
+        F.close()
+
+    def export(self, basename=None):
+        if basename is None:
+            basename = time.strftime('profile-%Y%m%d-%H%M%S')
+        self.export_json(basename + '.json')
+        self.export_csv(basename + '.csv')
+        print 'Wrote %s.json and %s.csv' % (basename, basename)
+
+profiler = Profiler()
+
+
+def timed(name):
+    def decorate(func):
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            profiler.depth += 1
+            start = default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.depth -= 1
+                profiler.record(name, default_timer() - start)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorate
+
+def install_keys(app):
+    app.accept('f3', profiler.toggle)
+    app.accept('f4', profiler.export)
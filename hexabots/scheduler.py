@@ -0,0 +1,189 @@
+# Event-driven replacement for the CT charging loop.
+#
+# The loop charged every living character by CHARGE_STEP * efficiency per
+# pass, in roster order, and stopped at the first character to reach 1.0. The
+# next search started a new pass from the top of the roster, so characters
+# after the actor missed the rest of that pass. The scheduler keeps, for each
+# roster slot, the number of passes that character still needs, in a min
+# segment tree with lazy range adds. Finding the next actor is a root lookup
+# and accounting for the passes that went by is two range adds, so a turn
+# costs O(log n) however long the wait was.
+#
+# CT values are only brought up to date when a character's CT or efficiency
+# is about to change (see sync), by reproducing the float additions the loop
+# made a binade at a time (see charge), so ready times and turn order match it
+# exactly at a cost that does not grow with the number of passes.
+
+from math import frexp, ldexp
+
+CHARGE_STEP = 0.001
+NEVER = 1 << 60
+
+
+def charge(ct, increment, limit):
+    # Makes up to limit of the loop's additions of increment to ct, stopping
+    # once it reaches 1.0 or stops moving, and returns (ct, additions made).
+    # Between consecutive powers of two every float has the same spacing, so
+    # once an addition has landed in the same binade it started from, each
+    # further one adds the same rounded step (a tie rounds to even, after
+    # which ties keep rounding the same way). The run of additions through a
+    # binade is therefore made in one multiplication, and the whole charge in
+    # a few steps per binade rather than one per pass.
+    passes = 0
+    while passes < limit and ct < 1.0:
+        charged = ct + increment
+        if charged == ct:
+            break
+        (negative, exponent) = (ct < 0.0, frexp(ct)[1])
+        ct = charged
+        passes += 1
+        if ct < 1.0 and (ct < 0.0) == negative and frexp(ct)[1] == exponent:
+            step = (ct + increment) - ct
+            # Keep clear of the binade's end, where the spacing changes; the
+            # last few additions are made one at a time
+            if negative:
+                end = -ldexp(0.5, exponent)
+            else:
+                end = min(ldexp(1.0, exponent), 1.0)
+            jump = min(int((end - ct) / step) - 2, limit - passes)
+            if jump > 0:
+                ct += jump * step
+                passes += jump
+    return (ct, passes)
+
+def passes_to_ready(ct, efficiency):
+    # The loop charges before it checks, so even a full character needs a pass.
+    increment = CHARGE_STEP * efficiency
+    if ct >= 1.0:
+        if ct + increment == ct:
+            return NEVER
+        return 1
+    if increment <= 0.0:
+        return NEVER
+    (ct, passes) = charge(ct, increment, NEVER)
+    if ct < 1.0:
+        # Efficiency too small to ever move CT; the loop would spin forever.
+        return NEVER
+    return passes
+
+def replay_charge(ct, efficiency, passes):
+    if passes <= 0:
+        return ct
+    return min(charge(ct, CHARGE_STEP * efficiency, passes)[0], 1.0)
+
+
+class CTScheduler(object):
+    def __init__(self, teams):
+        self.roster = []
+        self.slots = {}
+        for team in teams:
+            for character in team.characters:
+                self.slots[character] = len(self.roster)
+                self.roster.append(character)
+        self.size = 1
+        while self.size < max(1, len(self.roster)):
+            self.size *= 2
+        # Tree keys pack (passes remaining, slot) into one int so that ties
+        # go to the earlier slot, as they did in the loop.
+        self.tree = [NEVER * self.size] * (2 * self.size)
+        self.lazy = [0] * (2 * self.size)
+        # Per slot: CT and passes needed at the time of the last sync.
+        self.base_ct = [0.0] * len(self.roster)
+        self.base_passes = [NEVER] * len(self.roster)
+        for character in self.roster:
+            if not character.is_dead:
+                self.reschedule(character)
+
+    def _apply(self, node, delta):
+        self.tree[node] += delta
+        if node < self.size:
+            self.lazy[node] += delta
+
+    def _push(self, node):
+        delta = self.lazy[node]
+        if delta:
+            self._apply(2 * node, delta)
+            self._apply(2 * node + 1, delta)
+            self.lazy[node] = 0
+
+    def _add(self, lo, hi, delta, node=1, node_lo=0, node_hi=None):
+        if node_hi is None:
+            node_hi = self.size - 1
+        if hi < node_lo or node_hi < lo:
+            return
+        if lo <= node_lo and node_hi <= hi:
+            self._apply(node, delta)
+            return
+        self._push(node)
+        mid = (node_lo + node_hi) // 2
+        self._add(lo, hi, delta, 2 * node, node_lo, mid)
+        self._add(lo, hi, delta, 2 * node + 1, mid + 1, node_hi)
+        self.tree[node] = min(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def _path(self, slot):
+        node = 1
+        path = []
+        lo, hi = 0, self.size - 1
+        while node < self.size:
+            path.append(node)
+            self._push(node)
+            mid = (lo + hi) // 2
+            if slot <= mid:
+                node, hi = 2 * node, mid
+            else:
+                node, lo = 2 * node + 1, mid + 1
+        return (node, path)
+
+    def _set(self, slot, passes):
+        (leaf, path) = self._path(slot)
+        self.tree[leaf] = min(passes, NEVER) * self.size + slot
+        for node in reversed(path):
+            self.tree[node] = min(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def _remaining(self, slot):
+        (leaf, path) = self._path(slot)
+        return self.tree[leaf] // self.size
+
+    def _passes_done(self, slot):
+        if self.base_passes[slot] >= NEVER:
+            return 0
+        return self.base_passes[slot] - self._remaining(slot)
+
+    def current_ct(self, character):
+        slot = self.slots[character]
+        if character.is_dead:
+            return character.CT
+        return replay_charge(self.base_ct[slot], character.efficiency, self._passes_done(slot))
+
+    def sync(self, character):
+        # Bring character.CT up to date before it or efficiency is changed.
+        character.CT = self.current_ct(character)
+        self.reschedule(character)
+
+    def reschedule(self, character):
+        slot = self.slots[character]
+        if character.is_dead:
+            self.remove(character)
+            return
+        self.base_ct[slot] = character.CT
+        self.base_passes[slot] = passes_to_ready(character.CT, character.efficiency)
+        self._set(slot, self.base_passes[slot])
+
+    def remove(self, character):
+        slot = self.slots[character]
+        self.base_passes[slot] = NEVER
+        self._set(slot, NEVER)
+
+    def next_actor(self):
+        key = self.tree[1]
+        (passes, slot) = divmod(key, self.size)
+        if passes >= NEVER // 2:
+            return None
+        # Everyone up to and including the actor was charged for `passes`
+        # passes; those after it missed the last, interrupted pass.
+        self._add(0, self.size - 1, -(passes - 1) * self.size)
+        self._add(0, slot, -self.size)
+        character = self.roster[slot]
+        character.CT = 1.0
+        self.reschedule(character)
+        return character
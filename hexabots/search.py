@@ -0,0 +1,364 @@
+# Lookahead computer player. Battles are searched as depth-limited
+# expectimax over a compact state: a tuple with one entry per living
+# character,
+#
+#   (team index, id, x, y, efficiency, CT, pending action)
+#
+# in scheduler roster order. The next actor is whoever fills its CT first.
+# A character with a pending action carries it out, which involves no
+# choice. Otherwise it chooses a new action, and each choice counts as one
+# ply. The searching team picks its best action. Other teams are chance
+# nodes that play the nearest-opponent rule with probability GREEDY_WEIGHT,
+# with any of their other candidate actions equally likely otherwise.
+#
+# Searches deepen one ply at a time until the node or time budget runs out,
+# and keep the deepest finished answer. Values are stored in a
+# transposition table keyed by state. The table persists between turns, so
+# the positions the last search looked at start the next one from the depth
+# they were searched to.
+#
+# CT charges continuously here rather than in the scheduler's discrete
+# passes, so the predicted turn order can differ from the real one near
+# ties. CT is rounded to CHARGE_STEP so that states reached by different
+# move orders still meet in the table.
+
+from timeit import default_timer
+from hexabots.hexgrid import hex_distance, offset_to_axial, axial_norm_squared
+from hexabots.scheduler import CHARGE_STEP
+from hexabots import battle
+from hexabots.battle import MOVE_RANGE, ATTACK_RANGE, ATTACK_DAMAGE, WAIT_COST
+from hexabots.battle import ATTACK_PRE_COST, ATTACK_POST_COST
+
+NODE_BUDGET = 1000
+# Seconds per decision when a time budget is used, as in play.py
+TIME_BUDGET = 0.05
+MAX_DEPTH = 8
+# Move destinations kept per choice, closest to the enemy first
+MOVE_CANDIDATES = 4
+# Chance that another team plays the nearest-opponent rule
+GREEDY_WEIGHT = 0.6
+WIN_SCORE = 100.0
+# Score lost per hex between a character and its nearest enemy
+APPROACH_WEIGHT = 0.01
+# Table entries kept before the table is emptied
+MAX_ENTRIES = 200000
+
+# Pending actions
+MOVE = 'move'
+ATTACK = 'attack'
+WAIT = 'wait'
+
+# Fields of a character's entry
+(TEAM, ID, X, Y, EFFICIENCY, CT, PENDING) = range(7)
+
+# Team index -> SearchAI, for the world searched last
+_players = {}
+
+
+class OutOfBudget(Exception):
+    pass
+
+
+def _round_ct(ct):
+    return round(min(ct, 1.0) / CHARGE_STEP) * CHARGE_STEP
+
+def _pending(action):
+    if isinstance(action, battle.Move):
+        return (MOVE, action.tile.x, action.tile.y, action.post_cost())
+    if isinstance(action, battle.Attack):
+        return (ATTACK, action.target.team.index, action.target.id)
+    if isinstance(action, battle.Wait):
+        return (WAIT,)
+    return None
+
+def compact_state(world):
+    scheduler = world.scheduler
+    units = []
+    for team in world.teams:
+        for character in team.characters:
+            if character.is_dead or character.efficiency <= 0.0:
+                continue
+            if scheduler:
+                ct = scheduler.current_ct(character)
+            else:
+                ct = character.CT
+            units.append((team.index, character.id, character.x, character.y,
+                    character.efficiency, _round_ct(ct), _pending(character.pending_action)))
+    return tuple(units)
+
+def in_attack_range(x1, y1, x2, y2):
+    # The same test as find_nearby(..., ATTACK_RANGE)
+    (q1, r1) = offset_to_axial(x1, y1)
+    (q2, r2) = offset_to_axial(x2, y2)
+    return axial_norm_squared(q2 - q1, r2 - r1) <= ATTACK_RANGE ** 2
+
+
+class SearchAI(object):
+    def __init__(self, world, team_index, node_budget=NODE_BUDGET, time_budget=None):
+        self.world = world
+        self.terrain = world.terrain
+        self.team_index = team_index
+        self.node_budget = node_budget
+        self.time_budget = time_budget
+        # state -> (depth searched, value)
+        self.table = {}
+        # (x, y, blocked) -> [(cost, x2, y2)]
+        self.floods = {}
+        self.terrain.add_height_listener(self.heights_changed)
+        self.nodes = 0
+        self.deadline = None
+        self.depth_reached = 0
+
+    def heights_changed(self, coords):
+        self.table = {}
+        self.floods = {}
+
+    # Rules on compact states
+
+    def next_actor(self, units):
+        # Returns the actor's index and the units charged up to its turn
+        best = None
+        for (i, unit) in enumerate(units):
+            efficiency = unit[EFFICIENCY]
+            if efficiency <= 0.0:
+                continue
+            wait = max(0.0, 1.0 - unit[CT]) / efficiency
+            if best is None or wait < best[0]:
+                best = (wait, i)
+        if best is None:
+            return (None, units)
+        (wait, actor) = best
+        charged = []
+        for (i, unit) in enumerate(units):
+            if i == actor:
+                ct = 1.0
+            else:
+                ct = _round_ct(unit[CT] + wait * unit[EFFICIENCY])
+            charged.append(unit[:CT] + (ct,) + unit[CT + 1:])
+        return (actor, charged)
+
+    def flood(self, units, actor):
+        unit = units[actor]
+        pathfinder = self.terrain.get_pathfinder()
+        # Characters too far away to be stepped on leave the flood as it is,
+        # so they are left out of the key
+        steps = int(MOVE_RANGE / pathfinder.costs.min_step_cost()) + 1
+        blocked = frozenset([(u[X], u[Y]) for (i, u) in enumerate(units) if i != actor
+                and hex_distance(unit[X], unit[Y], u[X], u[Y]) <= steps])
+        key = (unit[X], unit[Y], blocked)
+        tiles = self.floods.get(key)
+        if tiles is None:
+            if len(self.floods) > MAX_ENTRIES:
+                self.floods = {}
+            reach = pathfinder.reachable(self.terrain.tile(unit[X], unit[Y]), MOVE_RANGE, blocked)
+            tiles = sorted([(cost, x, y) for ((x, y), cost) in reach.costs.items()
+                    if (x, y) != (unit[X], unit[Y])])
+            self.floods[key] = tiles
+        return tiles
+
+    def nearest_enemy(self, units, unit):
+        # By distance between tile centres, as find_opponent measures it
+        positions = self.terrain.get_tables().positions
+        size_y = self.terrain.size_y
+        i = 2 * (unit[X] * size_y + unit[Y])
+        best = None
+        for other in units:
+            if other[TEAM] == unit[TEAM]:
+                continue
+            j = 2 * (other[X] * size_y + other[Y])
+            (dx, dy) = (positions[i] - positions[j], positions[i + 1] - positions[j + 1])
+            distance = dx * dx + dy * dy
+            if best is None or distance < best[0]:
+                best = (distance, other)
+        return best and best[1]
+
+    def choices(self, units, actor):
+        # Returns (choices, index of the nearest-opponent rule's choice)
+        unit = units[actor]
+        sight = self.terrain.get_sight()
+        source = self.terrain.tile(unit[X], unit[Y])
+        attacks = []
+        for other in units:
+            if other[TEAM] != unit[TEAM] and in_attack_range(unit[X], unit[Y], other[X], other[Y]):
+                if sight.can_see(source, self.terrain.tile(other[X], other[Y])):
+                    attacks.append((ATTACK, other[TEAM], other[ID]))
+        target = self.nearest_enemy(units, unit)
+        if target is None:
+            return ([(WAIT,)], 0)
+        tiles = self.flood(units, actor)
+        # The rule attacks its target when it can, and otherwise moves to
+        # the reachable tile nearest it in grid distance
+        greedy = None
+        target_attack = (ATTACK, target[TEAM], target[ID])
+        if target_attack in attacks:
+            greedy = target_attack
+        else:
+            closest = None
+            for (cost, x, y) in tiles:
+                distance = (x - target[X]) ** 2 + (y - target[Y]) ** 2
+                if distance > 0 and (closest is None or distance < closest[0]):
+                    closest = (distance, (MOVE, x, y, cost / MOVE_RANGE))
+            if closest:
+                greedy = closest[1]
+        moves = sorted([(hex_distance(x, y, target[X], target[Y]), cost, x, y)
+                for (cost, x, y) in tiles])
+        choices = attacks + [(MOVE, x, y, cost / MOVE_RANGE)
+                for (distance, cost, x, y) in moves[:MOVE_CANDIDATES]]
+        if greedy is None:
+            greedy = (WAIT,)
+        if greedy not in choices:
+            choices.append(greedy)
+        return (choices, choices.index(greedy))
+
+    def choose(self, units, actor, choice):
+        unit = units[actor]
+        if choice[0] == ATTACK:
+            cost = ATTACK_PRE_COST
+        else:
+            cost = 0.0
+        units = list(units)
+        units[actor] = unit[:CT] + (_round_ct(unit[CT] - cost), choice)
+        return tuple(units)
+
+    def carry_out(self, units, actor):
+        unit = units[actor]
+        pending = unit[PENDING]
+        units = list(units)
+        (x, y) = (unit[X], unit[Y])
+        if pending[0] == MOVE:
+            cost = pending[3]
+            if not [u for u in units if (u[X], u[Y]) == (pending[1], pending[2])]:
+                (x, y) = (pending[1], pending[2])
+        elif pending[0] == ATTACK:
+            cost = ATTACK_POST_COST
+            for (i, other) in enumerate(units):
+                if (other[TEAM], other[ID]) == pending[1:] and in_attack_range(x, y, other[X], other[Y]):
+                    efficiency = other[EFFICIENCY] - ATTACK_DAMAGE
+                    if efficiency <= 0.0:
+                        efficiency = 0.0
+                    units[i] = other[:EFFICIENCY] + (efficiency,) + other[EFFICIENCY + 1:]
+        else:
+            cost = WAIT_COST
+        units[actor] = (unit[TEAM], unit[ID], x, y, unit[EFFICIENCY], _round_ct(unit[CT] - cost), None)
+        return tuple([u for u in units if u[EFFICIENCY] > 0.0])
+
+    def evaluate(self, units):
+        teams = set([unit[TEAM] for unit in units])
+        score = 0.0
+        if self.team_index not in teams:
+            return score - WIN_SCORE
+        if len(teams) == 1:
+            score += WIN_SCORE
+        own = 0
+        for unit in units:
+            if unit[TEAM] == self.team_index:
+                score += unit[EFFICIENCY]
+                own += 1
+                enemy = self.nearest_enemy(units, unit)
+                if enemy:
+                    score -= APPROACH_WEIGHT * hex_distance(unit[X], unit[Y], enemy[X], enemy[Y])
+            else:
+                score -= unit[EFFICIENCY]
+        return score
+
+    # Search
+
+    def count_node(self):
+        self.nodes += 1
+        if self.nodes > self.node_budget:
+            raise OutOfBudget()
+        if self.deadline is not None and self.nodes & 15 == 0 and default_timer() > self.deadline:
+            raise OutOfBudget()
+
+    def value(self, units, depth):
+        # Expected score of a state where the next actor is still to be found
+        self.count_node()
+        if depth <= 0 or len(set([unit[TEAM] for unit in units])) <= 1:
+            return self.evaluate(units)
+        entry = self.table.get(units)
+        if entry is not None and entry[0] >= depth:
+            return entry[1]
+        (actor, charged) = self.next_actor(units)
+        if actor is None:
+            return self.evaluate(units)
+        charged = tuple(charged)
+        if charged[actor][PENDING] is not None:
+            result = self.value(self.carry_out(charged, actor), depth)
+        else:
+            result = self.decide(charged, actor, depth)
+        self.store(units, depth, result)
+        return result
+
+    def decide(self, units, actor, depth):
+        (choices, greedy) = self.choices(units, actor)
+        values = [self.value(self.choose(units, actor, choice), depth - 1) for choice in choices]
+        if units[actor][TEAM] == self.team_index:
+            return max(values)
+        if len(values) == 1:
+            return values[0]
+        other = (1.0 - GREEDY_WEIGHT) / (len(values) - 1)
+        return sum([value * (i == greedy and GREEDY_WEIGHT or other)
+                for (i, value) in enumerate(values)])
+
+    def store(self, units, depth, value):
+        if len(self.table) > MAX_ENTRIES:
+            self.table = {}
+        entry = self.table.get(units)
+        if entry is None or entry[0] <= depth:
+            self.table[units] = (depth, value)
+
+    def search(self, units, actor):
+        # Returns the actor's best choice on a state where it is about to
+        # choose
+        self.nodes = 0
+        self.depth_reached = 0
+        if self.time_budget is not None:
+            self.deadline = default_timer() + self.time_budget
+        else:
+            self.deadline = None
+        (choices, greedy) = self.choices(units, actor)
+        if len(choices) == 1:
+            return choices[0]
+        best = greedy
+        for depth in range(1, MAX_DEPTH + 1):
+            try:
+                values = [self.value(self.choose(units, actor, choice), depth - 1)
+                        for choice in choices]
+            except OutOfBudget:
+                break
+            best = max(range(len(values)), key=lambda i: (values[i], -i))
+            self.depth_reached = depth
+        return choices[best]
+
+    def choose_action(self, character):
+        units = list(compact_state(self.world))
+        keys = [(unit[TEAM], unit[ID]) for unit in units]
+        actor = keys.index((character.team.index, character.id))
+        units[actor] = units[actor][:CT] + (1.0, None)
+        choice = self.search(tuple(units), actor)
+        if choice[0] == ATTACK:
+            team = self.world.teams[choice[1]]
+            return battle.Attack(character, team.characters_dict[choice[2]])
+        if choice[0] == MOVE:
+            return battle.Move(character, self.terrain.tile(choice[1], choice[2]))
+        return battle.Wait(character)
+
+
+def get_player(world, team_index, node_budget=NODE_BUDGET, time_budget=None):
+    # Players are kept for one world at a time, so finished battles are not
+    # held on to
+    for player in _players.values():
+        if player.world is not world or player.terrain is not world.terrain:
+            player.terrain.remove_height_listener(player.heights_changed)
+            _players.clear()
+            break
+    player = _players.get(team_index)
+    if player is None:
+        player = _players[team_index] = SearchAI(world, team_index, node_budget, time_budget)
+    player.node_budget = node_budget
+    player.time_budget = time_budget
+    return player
+
+def choose_action(world, character, node_budget=NODE_BUDGET, time_budget=None):
+    # Battle controller; with only a node budget the choice is repeatable
+    return get_player(world, character.team.index, node_budget, time_budget).choose_action(character)
@@ -0,0 +1,90 @@
+# Line of sight over the column heights. A line between two tiles runs from
+# eye height above the first column to eye height above the second, over the
+# hex line joining them, and is blocked by any column in between that rises
+# above it.
+#
+# Results are cached per source tile. When columns change height, only the
+# sources whose cached queries reach that far are dropped; every line from a
+# source stays within that distance of it, so nothing else can be affected.
+
+from hexabots.hexgrid import offset_to_axial, axial_to_offset, axial_round, axial_distance
+
+# Height of a unit's eyes, and of the point looked at, above its column
+EYE_HEIGHT = 4.0
+# Nudge keeping lines that run exactly along hex edges on one side
+EPSILON = (1e-6, 2e-6)
+
+
+def hex_line(x1, y1, x2, y2):
+    # Tiles on the line between two tiles, both ends included
+    (q1, r1) = offset_to_axial(x1, y1)
+    (q2, r2) = offset_to_axial(x2, y2)
+    steps = axial_distance(q2 - q1, r2 - r1)
+    if steps == 0:
+        return [(x1, y1)]
+    (fq, fr) = (q1 + EPSILON[0], r1 + EPSILON[1])
+    (dq, dr) = (float(q2 - q1) / steps, float(r2 - r1) / steps)
+    line = []
+    for i in xrange(steps + 1):
+        line.append(axial_to_offset(*axial_round(fq + dq * i, fr + dr * i)))
+    return line
+
+
+class LineOfSight(object):
+    def __init__(self, terrain):
+        self.terrain = terrain
+        # (x, y) -> [farthest hex distance queried, {(x2, y2): visible}]
+        self.cache = {}
+        terrain.add_height_listener(self.heights_changed)
+
+    def trace(self, x1, y1, x2, y2):
+        terrain = self.terrain
+        height_at = terrain.height_at
+        line = hex_line(x1, y1, x2, y2)
+        steps = len(line) - 1
+        start = height_at(x1, y1) + EYE_HEIGHT
+        rise = height_at(x2, y2) + EYE_HEIGHT - start
+        for i in xrange(1, steps):
+            (x, y) = line[i]
+            # Lines hugging the board edge may round to a tile just past it
+            if not (0 <= x < terrain.size_x and 0 <= y < terrain.size_y):
+                continue
+            if height_at(x, y) > start + rise * i / steps:
+                return False
+        return True
+
+    def can_see(self, source, target):
+        key = (source.x, source.y)
+        coord = (target.x, target.y)
+        entry = self.cache.get(key)
+        if entry is not None and coord in entry[1]:
+            return entry[1][coord]
+        distance = axial_distance(*self._delta(key, coord))
+        if entry is None:
+            entry = self.cache[key] = [distance, {}]
+        elif distance > entry[0]:
+            entry[0] = distance
+        visible = entry[1][coord] = self.trace(source.x, source.y, target.x, target.y)
+        return visible
+
+    def visible_tiles(self, source, tiles):
+        return [tile for tile in tiles if self.can_see(source, tile)]
+
+    def _delta(self, coord1, coord2):
+        (q1, r1) = offset_to_axial(*coord1)
+        (q2, r2) = offset_to_axial(*coord2)
+        return (q2 - q1, r2 - r1)
+
+    def heights_changed(self, coords):
+        if coords is None:
+            self.cache = {}
+            return
+        for key in self.cache.keys():
+            reach = self.cache[key][0]
+            for coord in coords:
+                if axial_distance(*self._delta(key, coord)) <= reach:
+                    del self.cache[key]
+                    break
+
+    def clear(self):
+        self.cache = {}
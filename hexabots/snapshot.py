@@ -0,0 +1,167 @@
+# Immutable snapshots of a battle. A BattleState holds each character's
+# position, CT, efficiency, death and pending action as a plain tuple, one
+# tuple of records per team, along with the terrain version it was taken at.
+# Pending actions are recorded as plain tuples too, and made into action
+# objects again by restore(). Nothing refers back to characters, tiles,
+# terrain or nodepaths, so states cost little to keep, are safe to share and
+# compare equal whenever the battle is in the same position.
+#
+# Changing a character gives a new state that shares every other team's
+# records with the old one, so branching costs the size of one team. Undo is
+# holding on to the old state, and restore() with the state the world is at
+# only touches the characters that differ.
+
+# Fields of a character's record
+(X, Y, CT, EFFICIENCY, IS_DEAD, PENDING) = range(6)
+
+# Pending actions, recorded as (MOVE, x, y), (ATTACK, team index, character
+# id) or (WAIT,)
+MOVE = 'move'
+ATTACK = 'attack'
+WAIT = 'wait'
+
+
+class BattleState(object):
+    def __init__(self, teams, slots, roster, terrain_version):
+        # teams is a tuple per team of records in roster order. slots maps
+        # (team index, character id) to (team position, character position)
+        # and roster is the reverse; both are shared by every state derived
+        # from the same capture.
+        self.teams = teams
+        self.slots = slots
+        self.roster = roster
+        self.terrain_version = terrain_version
+
+    def __eq__(self, other):
+        return isinstance(other, BattleState) and self.teams == other.teams
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.teams)
+
+    def keys(self):
+        return [key for team in self.roster for key in team]
+
+    def get(self, team_index, character_id):
+        (i, j) = self.slots[(team_index, character_id)]
+        return self.teams[i][j]
+
+    def replace(self, team_index, character_id, **fields):
+        # A new state with some of one character's fields changed, given by
+        # lower-case field name
+        (i, j) = self.slots[(team_index, character_id)]
+        record = list(self.teams[i][j])
+        for (name, value) in fields.items():
+            record[FIELDS[name]] = value
+        team = self.teams[i]
+        team = team[:j] + (tuple(record),) + team[j + 1:]
+        return BattleState(self.teams[:i] + (team,) + self.teams[i + 1:], self.slots,
+                self.roster, self.terrain_version)
+
+    def move(self, team_index, character_id, x, y):
+        return self.replace(team_index, character_id, x=x, y=y)
+
+    def damage(self, team_index, character_id, damage):
+        efficiency = self.get(team_index, character_id)[EFFICIENCY] - damage
+        return self.replace(team_index, character_id, efficiency=max(efficiency, 0.0))
+
+    def kill(self, team_index, character_id):
+        return self.replace(team_index, character_id, is_dead=True)
+
+    def changed(self, other):
+        # Keys of the characters whose records differ from other's. Teams
+        # and records shared between the two are skipped without comparing.
+        keys = []
+        for (i, team) in enumerate(self.teams):
+            other_team = other.teams[i]
+            if team is other_team:
+                continue
+            for (j, record) in enumerate(team):
+                if record is not other_team[j] and record != other_team[j]:
+                    keys.append(self.roster[i][j])
+        return keys
+
+FIELDS = {'x': X, 'y': Y, 'ct': CT, 'efficiency': EFFICIENCY, 'is_dead': IS_DEAD,
+        'pending': PENDING}
+
+
+def pending_record(action):
+    from hexabots import battle
+    if isinstance(action, battle.Move):
+        return (MOVE, action.tile.x, action.tile.y)
+    if isinstance(action, battle.Attack):
+        return (ATTACK, action.target.team.index, action.target.id)
+    if isinstance(action, battle.Wait):
+        return (WAIT,)
+    return None
+
+def pending_action(world, character, record, actions=None):
+    # actions maps MOVE, ATTACK and WAIT to the classes to build, e.g.
+    # play.py's animated ones; the headless rules' are the default
+    from hexabots import battle
+    if record is None:
+        return None
+    classes = {MOVE: battle.Move, ATTACK: battle.Attack, WAIT: battle.Wait}
+    classes.update(actions or {})
+    kind = record[0]
+    if kind == MOVE:
+        return classes[MOVE](character, world.terrain.tile(record[1], record[2]))
+    if kind == ATTACK:
+        return classes[ATTACK](character, world.teams[record[1]].characters_dict[record[2]])
+    return classes[WAIT](character)
+
+def capture(world):
+    scheduler = world.scheduler
+    teams = []
+    slots = {}
+    roster = []
+    for (i, team) in enumerate(world.teams):
+        records = []
+        roster.append(tuple([(team.index, character.id) for character in team.characters]))
+        for (j, character) in enumerate(team.characters):
+            if scheduler and not character.is_dead:
+                ct = scheduler.current_ct(character)
+            else:
+                ct = character.CT
+            records.append((character.x, character.y, ct, character.efficiency,
+                    character.is_dead, pending_record(character.pending_action)))
+            slots[(team.index, character.id)] = (i, j)
+        teams.append(tuple(records))
+    return BattleState(tuple(teams), slots, tuple(roster), world.terrain.version)
+
+def restore(world, state, current=None, actions=None):
+    # Puts the world's characters back as they were in state. current is
+    # the state the world is in now, if known, and limits the work to the
+    # characters that differ from it. actions is as for pending_action.
+    if current is None:
+        keys = state.keys()
+    else:
+        keys = state.changed(current)
+    terrain = world.terrain
+    for (team_index, character_id) in keys:
+        character = world.teams[team_index].characters_dict[character_id]
+        (x, y, ct, efficiency, is_dead, pending) = state.get(team_index, character_id)
+        if not character.is_dead:
+            terrain.remove_occupant(character)
+        tile = terrain.tile(x, y)
+        character.tile = tile
+        (character.x, character.y, character.height) = (x, y, tile.height)
+        if is_dead and not character.is_dead:
+            character.die()
+        elif not is_dead:
+            character.is_dead = False
+            terrain.add_occupant(character)
+            if world.nodePath:
+                if character.nodePath is None or character.nodePath.isEmpty():
+                    character.init_nodepath()
+                else:
+                    character.nodePath.setPos(*terrain.position(x, y, tile.height))
+        character.CT = ct
+        character.efficiency = efficiency
+        if pending_record(character.pending_action) != pending:
+            character.pending_action = pending_action(world, character, pending, actions)
+        character.reschedule()
+        if world.fog:
+            world.fog.update(character)
@@ -0,0 +1,184 @@
+# Seeded procedural terrain. Heights come from fractal value noise sampled at
+# the tile centres; ground below the water level becomes flat water and
+# steep ground becomes stone. With numpy installed whole fields are computed
+# at once, otherwise the same arithmetic runs a column at a time in plain
+# Python, several times slower. Both give the same map for the same seed and
+# parameters.
+
+import math
+from array import array
+from operator import sub
+from hexabots.hexgrid import SQRT_3_2
+from hexabots.arrayterrain import MATERIAL_IDS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+GRASS = MATERIAL_IDS['grass']
+STONE = MATERIAL_IDS['stone']
+WATER = MATERIAL_IDS['water']
+# Height given to water and the lowest land, as in a flat board
+BASE_HEIGHT = 2
+MASK = 0xffffffff
+
+
+def _octave_seed(seed, octave):
+    return ((seed + octave * 1013) & MASK) * 2246822519 & MASK
+
+def _lattice(ix, iy, seed_term):
+    # Hash of a lattice point to [0, 1]. Works on ints and on uint64 arrays.
+    h = (ix * 374761393 + iy * 668265263 + seed_term) & MASK
+    h = ((h ^ (h >> 13)) * 1274126177) & MASK
+    h = h ^ (h >> 16)
+    return h / 4294967295.0
+
+def _smooth(t):
+    return t * t * (3.0 - 2.0 * t)
+
+def _noise(px, py, seed_term, floor):
+    x0 = floor(px)
+    y0 = floor(py)
+    u = _smooth(px - x0)
+    v = _smooth(py - y0)
+    (h00, h10, h01, h11) = _corners(x0, y0, seed_term)
+    a = h00 + (h10 - h00) * u
+    b = h01 + (h11 - h01) * u
+    return a + (b - a) * v
+
+def _corners(x0, y0, seed_term):
+    if numpy is None or not isinstance(x0, numpy.ndarray):
+        (ix, iy) = (int(x0), int(y0))
+        return (_lattice(ix, iy, seed_term), _lattice(ix + 1, iy, seed_term),
+                _lattice(ix, iy + 1, seed_term), _lattice(ix + 1, iy + 1, seed_term))
+    # Hash each lattice point under the field once, then look the corners up
+    ix = x0.astype(numpy.int64)
+    iy = y0.astype(numpy.int64)
+    (x_min, y_min) = (ix.min(), iy.min())
+    (ix, iy) = (ix - x_min, iy - y_min)
+    xs = numpy.arange(x_min, x_min + ix.max() + 2, dtype=numpy.uint64)[:, numpy.newaxis]
+    ys = numpy.arange(y_min, y_min + iy.max() + 2, dtype=numpy.uint64)[numpy.newaxis, :]
+    table = _lattice(xs, ys, seed_term).ravel()
+    width = ys.shape[1]
+    index = ix * width + iy
+    return (table.take(index), table.take(index + width), table.take(index + 1),
+            table.take(index + width + 1))
+
+def _fractal(px, py, seed, scale, octaves, lacunarity, gain, floor):
+    # Sum of octaves, normalised back to [0, 1]
+    total = 0.0
+    norm = 0.0
+    amplitude = 1.0
+    frequency = 1.0 / scale
+    for octave in range(octaves):
+        total = total + amplitude * _noise(px * frequency, py * frequency,
+                _octave_seed(seed, octave), floor)
+        norm += amplitude
+        amplitude *= gain
+        frequency *= lacunarity
+    return total / norm
+
+def _height(value, water_level, max_height):
+    # Quantised like Tile.set_height, rounding halves up on every backend
+    raw = max_height * (value - water_level) / (1.0 - water_level)
+    return BASE_HEIGHT + 2 * math.floor(max(raw, 0.0) / 2.0 + 0.5)
+
+
+def noise_values(coords, seed=0, scale=24.0, octaves=5, lacunarity=2.0, gain=0.5):
+    # Fractal noise in [0, 1] at the centres of the given tiles, the same
+    # field generate_fields samples
+    return [_fractal(0.75 * x, SQRT_3_2 * (y + 0.5 * (x & 1)), seed, scale, octaves,
+            lacunarity, gain, math.floor) for (x, y) in coords]
+
+def generate_fields(size_x, size_y, seed=0, scale=24.0, octaves=5, lacunarity=2.0,
+        gain=0.5, max_height=48.0, water_level=0.35, stone_slope=4.0):
+    # Returns (heights, materials) as x-major arrays like ArrayTerrain's.
+    # scale is the size of the largest features in tiles; stone_slope is the
+    # height difference to a neighbour at which ground turns to stone.
+    if numpy is not None:
+        return _generate_numpy(size_x, size_y, seed, scale, octaves, lacunarity,
+                gain, max_height, water_level, stone_slope)
+    return _generate_columns(size_x, size_y, seed, scale, octaves, lacunarity, gain,
+            max_height, water_level, stone_slope)
+
+def _generate_columns(size_x, size_y, seed, scale, octaves, lacunarity, gain,
+        max_height, water_level, stone_slope):
+    # The same arithmetic as _fractal and _height, a column of tiles at a
+    # time. For each octave the lattice is hashed once, and the tiles'
+    # lattice rows and weights, which only depend on the column's parity,
+    # are worked out once. Along a column the noise then interpolates
+    # between one list of values blended across x, in one list
+    # comprehension per column and octave.
+    columns = [[0.0] * size_y for x in xrange(size_x)]
+    norm = 0.0
+    amplitude = 1.0
+    frequency = 1.0 / scale
+    for octave in xrange(octaves):
+        seed_term = _octave_seed(seed, octave)
+        rows = []
+        for parity in (0, 1):
+            ys = [SQRT_3_2 * (y + 0.5 * parity) * frequency for y in xrange(size_y)]
+            iys = [int(math.floor(py)) for py in ys]
+            rows.append(zip(iys, [_smooth(py - iy) for (py, iy) in zip(ys, iys)]))
+        iy_max = max(rows[0][-1][0], rows[1][-1][0]) + 1
+        ix_max = int(math.floor(0.75 * (size_x - 1) * frequency)) + 1
+        lattice = [[_lattice(ix, iy, seed_term) for iy in xrange(iy_max + 1)]
+                for ix in xrange(ix_max + 1)]
+        for x in xrange(size_x):
+            px = 0.75 * x * frequency
+            ix = int(math.floor(px))
+            u = _smooth(px - ix)
+            # The noise along the column at each lattice row, and the step
+            # to the next row
+            a = [h0 + (h1 - h0) * u for (h0, h1) in zip(lattice[ix], lattice[ix + 1])]
+            d = [b - a0 for (a0, b) in zip(a, a[1:])]
+            noise = [a[iy] + d[iy] * v for (iy, v) in rows[x & 1]]
+            columns[x] = [t + amplitude * n for (t, n) in zip(columns[x], noise)]
+        norm += amplitude
+        amplitude *= gain
+        frequency *= lacunarity
+    floor = math.floor
+    scale = 1.0 - water_level
+    values = [[t / norm for t in column] for column in columns]
+    columns = [[BASE_HEIGHT + 2 * floor(max(max_height * (value - water_level) / scale, 0.0) / 2.0 + 0.5)
+            for value in column] for column in values]
+    heights = array('f')
+    materials = array('B')
+    for x in xrange(size_x):
+        column = columns[x]
+        # Steepest step to the neighbours sharing a row or column, as in
+        # _generate_numpy
+        steps = map(abs, map(sub, column[1:], column[:-1]))
+        slope = map(max, [0.0] + steps, steps + [0.0])
+        for other in (columns[x - 1:x], columns[x + 1:x + 2]):
+            for neighbour in other:
+                slope = map(max, slope, map(abs, map(sub, column, neighbour)))
+        materials.extend([value < water_level and WATER or (s >= stone_slope and STONE or GRASS)
+                for (value, s) in zip(values[x], slope)])
+        heights.extend(column)
+    return (heights, materials)
+
+def _generate_numpy(size_x, size_y, seed, scale, octaves, lacunarity, gain,
+        max_height, water_level, stone_slope):
+    x = numpy.arange(size_x, dtype=numpy.int64)[:, numpy.newaxis]
+    y = numpy.arange(size_y, dtype=numpy.float64)[numpy.newaxis, :]
+    # px only varies along x, so it stays a column and is broadcast
+    px = 0.75 * x
+    py = SQRT_3_2 * (y + 0.5 * (x & 1))
+    values = _fractal(px, py, seed, scale, octaves, lacunarity, gain, numpy.floor)
+    raw = max_height * (values - water_level) / (1.0 - water_level)
+    heights = BASE_HEIGHT + 2 * numpy.floor(numpy.maximum(raw, 0.0) / 2.0 + 0.5)
+    # Steepest step to the neighbours sharing a row or column, which are hex
+    # neighbours whatever the column's parity
+    slope = numpy.zeros((size_x, size_y))
+    step = numpy.abs(numpy.diff(heights, axis=0))
+    slope[1:, :] = numpy.maximum(slope[1:, :], step)
+    slope[:-1, :] = numpy.maximum(slope[:-1, :], step)
+    step = numpy.abs(numpy.diff(heights, axis=1))
+    slope[:, 1:] = numpy.maximum(slope[:, 1:], step)
+    slope[:, :-1] = numpy.maximum(slope[:, :-1], step)
+    materials = numpy.where(values < water_level, WATER,
+            numpy.where(slope >= stone_slope, STONE, GRASS)).astype(numpy.uint8)
+    return (array('f', heights.astype(numpy.float32).tostring()),
+            array('B', materials.tostring()))
@@ -0,0 +1,612 @@
+# Procedural terrain geometry. Instead of loading two models per tile, hex
+# columns are written straight into one Geom per CHUNK_SIZE x CHUNK_SIZE block
+# of tiles, with the material colour stored per vertex.
+#
+# Chunks hang off a quadtree of nodes so that culling can reject whole blocks
+# of the board at once. When the camera is zoomed out far enough, a coarse
+# mesh is shown instead, with each COARSE_FACTOR x COARSE_FACTOR block of
+# columns merged into one box. On boards with more than EAGER_CHUNKS chunks
+# the full-detail chunks are only built once they come into view, and the
+# ones out of view are dropped again when there are too many.
+#
+# Height edits only mark their chunks dirty. Once a frame, before rendering,
+# chunks with a few changed columns have those columns' vertices rewritten in
+# place, and chunks with more are tessellated again on a worker thread from
+# a copy of their heights, then swapped in when it is done.
+
+import math
+from array import array
+from pandac.PandaModules import Geom, GeomNode, GeomTriangles, GeomVertexData
+from pandac.PandaModules import GeomVertexFormat, GeomVertexArrayFormat
+from pandac.PandaModules import GeomVertexWriter, InternalName, VBase4
+from pandac.PandaModules import BoundingBox, Point3
+from direct.stdpy import threading
+from hexabots import HEX_DIAM, SQRT_3, MATERIAL_COLORS
+from hexabots.hexgrid import point_to_offset
+from hexabots.profiling import timed
+
+CHUNK_SIZE = 16
+HEX_RADIUS = HEX_DIAM / 2.0
+# Tiles per side merged into one column of the coarse mesh, and tiles per
+# side of a coarse chunk
+COARSE_FACTOR = 4
+COARSE_CHUNK_SIZE = 64
+# Show the coarse mesh when more than this many columns fit across the view
+COARSE_TILES_ACROSS = 400
+# Boards with more chunks than this build full-detail chunks on demand
+EAGER_CHUNKS = 256
+# Full-detail chunks kept around on such boards, and seconds per frame
+# spent building them
+MAX_CHUNKS = 600
+STREAM_BUDGET = 0.005
+# Changed columns in a chunk rewritten in place; past this the whole chunk is
+# tessellated again
+PATCH_LIMIT = 32
+# Rebuild after the frame's edits and before ShowBase's igLoop (sort 50)
+REBUILD_SORT = 45
+
+FINE = 'fine'
+COARSE = 'coarse'
+
+def _hex_corners():
+    corners = []
+    for i in range(6):
+        angle = math.radians(60 * i)
+        corners.append((HEX_RADIUS * math.cos(angle), HEX_RADIUS * math.sin(angle)))
+    return corners
+
+def _tile_template():
+    # (dx, dy, is_top, nx, ny, nz) for each vertex of one column, and the
+    # triangles joining them. The cap comes first, then six side quads.
+    corners = _hex_corners()
+    vertices = [(0.0, 0.0, True, 0.0, 0.0, 1.0)]
+    for (cx, cy) in corners:
+        vertices.append((cx, cy, True, 0.0, 0.0, 1.0))
+    triangles = []
+    for i in range(6):
+        triangles.append((0, 1 + i, 1 + (i + 1) % 6))
+    for i in range(6):
+        (x0, y0) = corners[i]
+        (x1, y1) = corners[(i + 1) % 6]
+        angle = math.radians(60 * i + 30)
+        (nx, ny) = (math.cos(angle), math.sin(angle))
+        start = len(vertices)
+        vertices.append((x0, y0, False, nx, ny, 0.0))
+        vertices.append((x1, y1, False, nx, ny, 0.0))
+        vertices.append((x1, y1, True, nx, ny, 0.0))
+        vertices.append((x0, y0, True, nx, ny, 0.0))
+        triangles.append((start, start + 1, start + 2))
+        triangles.append((start, start + 2, start + 3))
+    return (vertices, triangles)
+
+TILE_VERTICES, TILE_TRIANGLES = _tile_template()
+VERTS_PER_TILE = len(TILE_VERTICES)
+TILE_INDICES = [i for triangle in TILE_TRIANGLES for i in triangle]
+# (row, dx, dy) of the vertices that move with a column's height
+TOP_VERTICES = [(i, dx, dy) for (i, (dx, dy, is_top, nx, ny, nz)) in enumerate(TILE_VERTICES) if is_top]
+
+# Faces of a coarse column as (normal, corners), each corner given as
+# (at x1, at y1, at top) of the box [x0, x1] x [y0, y1] x [0, top]
+BOX_FACES = [
+        ((0.0, 0.0, 1.0), [(0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1)]),
+        ((0.0, -1.0, 0.0), [(0, 0, 0), (1, 0, 0), (1, 0, 1), (0, 0, 1)]),
+        ((1.0, 0.0, 0.0), [(1, 0, 0), (1, 1, 0), (1, 1, 1), (1, 0, 1)]),
+        ((0.0, 1.0, 0.0), [(1, 1, 0), (0, 1, 0), (0, 1, 1), (1, 1, 1)]),
+        ((-1.0, 0.0, 0.0), [(0, 1, 0), (0, 0, 0), (0, 0, 1), (0, 1, 1)]),
+]
+VERTS_PER_BOX = 4 * len(BOX_FACES)
+BOX_INDICES = [4 * face + i for face in range(len(BOX_FACES)) for i in (0, 1, 2, 0, 2, 3)]
+# Distance between neighbouring tile centres within a column
+ROW_SPACING = HEX_DIAM * SQRT_3 / 2
+
+_format = None
+
+def vertex_format():
+    # Positions and normals in one array, colours in another, so colour
+    # changes only rewrite the colour array.
+    global _format
+    if _format is None:
+        geometry = GeomVertexArrayFormat()
+        geometry.addColumn(InternalName.make('vertex'), 3, Geom.NTFloat32, Geom.CPoint)
+        geometry.addColumn(InternalName.make('normal'), 3, Geom.NTFloat32, Geom.CVector)
+        colors = GeomVertexArrayFormat()
+        colors.addColumn(InternalName.make('color'), 4, Geom.NTFloat32, Geom.CColor)
+        format = GeomVertexFormat()
+        format.addArray(geometry)
+        format.addArray(colors)
+        _format = GeomVertexFormat.registerFormat(format)
+    return _format
+
+
+class QuadNode(object):
+    # A block of chunks. Leaves hold a single chunk. top is the highest
+    # column underneath, for testing chunks that are not built yet.
+    def __init__(self, parent, nodePath, cx0, cy0, cx1, cy1):
+        self.parent = parent
+        self.nodePath = nodePath.attachNewNode('quad')
+        self.keys = (cx0, cy0, cx1, cy1)
+        self.children = []
+        self.top = 0.0
+
+
+class TerrainMesh(object):
+    # Tessellate heavily edited chunks on a worker thread rather than in
+    # the frame
+    threaded = True
+
+    def __init__(self, terrain, chunk_size=CHUNK_SIZE):
+        self.terrain = terrain
+        self.chunk_size = chunk_size
+        self.chunks = {}
+        # RGBA per tile, x-major like the terrain arrays
+        self.colors = array('f', [0.0]) * (4 * terrain.size_x * terrain.size_y)
+        self.fine_root = None
+        self.coarse_root = None
+        self.tree = None
+        self.leaves = {}
+        self.coarse_chunks = {}
+        # Coarse chunks that no longer match the tiles under them
+        self.coarse_dirty = set()
+        self.level = FINE
+        self.streaming = False
+        # Frame each full-detail chunk was last in view, when streaming
+        self.frame = 0
+        self.last_seen = {}
+        # Chunk -> (x, y) of the columns whose height changed since it was
+        # tessellated
+        self.dirty = {}
+        # The worker thread, the chunks it was given and what it has made
+        self.worker = None
+        self.building = set()
+        self.results = []
+
+    def chunk_of(self, x, y):
+        return (x // self.chunk_size, y // self.chunk_size)
+
+    def chunk_bounds(self, cx, cy):
+        x0 = cx * self.chunk_size
+        y0 = cy * self.chunk_size
+        x1 = min(x0 + self.chunk_size, self.terrain.size_x)
+        y1 = min(y0 + self.chunk_size, self.terrain.size_y)
+        return (x0, y0, x1, y1)
+
+    def chunk_counts(self):
+        nx = (self.terrain.size_x + self.chunk_size - 1) // self.chunk_size
+        ny = (self.terrain.size_y + self.chunk_size - 1) // self.chunk_size
+        return (nx, ny)
+
+    def chunk_keys(self):
+        (nx, ny) = self.chunk_counts()
+        return [(cx, cy) for cx in range(nx) for cy in range(ny)]
+
+    def terrain_index(self, x, y):
+        return x * self.terrain.size_y + y
+
+    def tile_row(self, x, y):
+        # First vertex of a tile inside its chunk's vertex data
+        (x0, y0, x1, y1) = self.chunk_bounds(*self.chunk_of(x, y))
+        return ((x - x0) * (y1 - y0) + (y - y0)) * VERTS_PER_TILE
+
+    def build(self):
+        for progress in self.build_steps():
+            pass
+
+    def build_steps(self):
+        # Yields the fraction done
+        terrain = self.terrain
+        for x in range(terrain.size_x):
+            for y in range(terrain.size_y):
+                self._store_color(x, y, MATERIAL_COLORS[terrain.material_at(x, y)])
+            yield 0.3 * (x + 1) / terrain.size_x
+        self.fine_root = terrain.nodePath.attachNewNode('fine')
+        self.coarse_root = terrain.nodePath.attachNewNode('coarse')
+        (nx, ny) = self.chunk_counts()
+        self.tree = self._build_tree(None, self.fine_root, 0, 0, nx, ny)
+        keys = self.coarse_keys()
+        for i, (kx, ky) in enumerate(keys):
+            self.build_coarse_chunk(kx, ky)
+            yield 0.3 + 0.2 * (i + 1) / len(keys)
+        self.streaming = nx * ny > EAGER_CHUNKS
+        if self.streaming:
+            taskMgr.add(self.stream_task, 'terrainChunks')
+        else:
+            keys = self.chunk_keys()
+            for i, (cx, cy) in enumerate(keys):
+                self.build_chunk(cx, cy)
+                yield 0.5 + 0.5 * (i + 1) / len(keys)
+        taskMgr.add(self.rebuild_task, 'terrainRebuild', sort=REBUILD_SORT)
+        self.set_level(self.level)
+        yield 1.0
+
+    def _build_tree(self, parent, nodePath, cx0, cy0, cx1, cy1):
+        node = QuadNode(parent, nodePath, cx0, cy0, cx1, cy1)
+        if cx1 - cx0 == 1 and cy1 - cy0 == 1:
+            self.leaves[(cx0, cy0)] = node
+            (x0, y0, x1, y1) = self.chunk_bounds(cx0, cy0)
+            node.top = self.top_height(x0, y0, x1, y1)
+            return node
+        mx = (cx0 + cx1 + 1) // 2
+        my = (cy0 + cy1 + 1) // 2
+        for (ax0, ax1) in [(cx0, mx), (mx, cx1)]:
+            for (ay0, ay1) in [(cy0, my), (my, cy1)]:
+                if ax0 < ax1 and ay0 < ay1:
+                    child = self._build_tree(node, node.nodePath, ax0, ay0, ax1, ay1)
+                    node.children.append(child)
+                    node.top = max(node.top, child.top)
+        return node
+
+    def top_height(self, x0, y0, x1, y1):
+        top = 0.0
+        for x in range(x0, x1):
+            for y in range(y0, y1):
+                top = max(top, self.terrain.height_at(x, y))
+        return top
+
+    def tile_box(self, x0, y0, x1, y1, top):
+        # Bounds of the columns in [x0, x1) x [y0, y1)
+        return BoundingBox(
+                Point3(0.75 * HEX_DIAM * x0 - HEX_RADIUS, ROW_SPACING * (y0 - 0.5), 0),
+                Point3(0.75 * HEX_DIAM * (x1 - 1) + HEX_RADIUS, ROW_SPACING * y1, top))
+
+    def node_box(self, node):
+        (cx0, cy0, cx1, cy1) = node.keys
+        (x0, y0) = self.chunk_bounds(cx0, cy0)[:2]
+        (x1, y1) = self.chunk_bounds(cx1 - 1, cy1 - 1)[2:]
+        return self.tile_box(x0, y0, x1, y1, node.top)
+
+    def clear(self):
+        taskMgr.remove('terrainChunks')
+        taskMgr.remove('terrainRebuild')
+        # A worker still running finishes into a list nothing reads
+        self.worker = None
+        self.building = set()
+        self.results = []
+        self.dirty = {}
+        for nodePath in self.chunks.values() + self.coarse_chunks.values():
+            nodePath.removeNode()
+        for nodePath in [self.fine_root, self.coarse_root]:
+            if nodePath:
+                nodePath.removeNode()
+        self.chunks = {}
+        self.coarse_chunks = {}
+        self.fine_root = self.coarse_root = self.tree = None
+        self.leaves = {}
+        self.last_seen = {}
+
+    def _make_node(self, name, geometry, colors, indices, parent):
+        vdata = GeomVertexData(name, vertex_format(), Geom.UHStatic)
+        vdata.uncleanSetNumRows(len(geometry) // 6)
+        vdata.modifyArray(0).modifyHandle().setData(geometry.tostring())
+        vdata.modifyArray(1).modifyHandle().setData(colors.tostring())
+        triangles = GeomTriangles(Geom.UHStatic)
+        if indices.typecode == 'I':
+            triangles.setIndexType(Geom.NTUint32)
+        vertices = triangles.modifyVertices()
+        vertices.uncleanSetNumRows(len(indices))
+        vertices.modifyHandle().setData(indices.tostring())
+        geom = Geom(vdata)
+        geom.addPrimitive(triangles)
+        node = GeomNode(name)
+        node.addGeom(geom)
+        return parent.attachNewNode(node)
+
+    def build_chunk(self, cx, cy):
+        bounds = self.chunk_bounds(cx, cy)
+        (geometry, indices) = self.tessellate(*bounds)
+        self.dirty.pop((cx, cy), None)
+        # Anything the worker is making for it is older than this
+        self.building.discard((cx, cy))
+        return self.install_chunk((cx, cy), geometry, self.chunk_colors(*bounds), indices)
+
+    def install_chunk(self, key, geometry, colors, indices):
+        old = self.chunks.get(key)
+        if old:
+            old.removeNode()
+        nodePath = self._make_node('chunk', geometry, colors, indices, self.leaves[key].nodePath)
+        nodePath.setTag('chunk', '%u,%u' % key)
+        self.chunks[key] = nodePath
+        return nodePath
+
+    def tessellate(self, x0, y0, x1, y1, heights=None):
+        # heights, if given, are the columns' heights in x-major order, for
+        # tessellating away from the terrain on the worker thread
+        if heights is None:
+            heights = self.chunk_heights(x0, y0, x1, y1)
+        heights = iter(heights)
+        geometry = array('f')
+        if (x1 - x0) * (y1 - y0) * VERTS_PER_TILE > 0xffff:
+            indices = array('I')
+        else:
+            indices = array('H')
+        base = 0
+        positions = self.terrain.get_tables().positions
+        for x in range(x0, x1):
+            for y in range(y0, y1):
+                i = 2 * self.terrain_index(x, y)
+                (px, py) = (positions[i], positions[i + 1])
+                height = heights.next()
+                for (dx, dy, is_top, nx, ny, nz) in TILE_VERTICES:
+                    geometry.extend((px + dx, py + dy, is_top and height or 0.0, nx, ny, nz))
+                indices.extend([base + k for k in TILE_INDICES])
+                base += VERTS_PER_TILE
+        return (geometry, indices)
+
+    def chunk_heights(self, x0, y0, x1, y1):
+        height_at = self.terrain.height_at
+        return [height_at(x, y) for x in range(x0, x1) for y in range(y0, y1)]
+
+    def chunk_colors(self, x0, y0, x1, y1):
+        colors = array('f')
+        for x in range(x0, x1):
+            for i in range(4 * self.terrain_index(x, y0), 4 * self.terrain_index(x, y1), 4):
+                colors.extend(self.colors[i:i + 4] * VERTS_PER_TILE)
+        return colors
+
+    def coarse_of(self, x, y):
+        return (x // COARSE_CHUNK_SIZE, y // COARSE_CHUNK_SIZE)
+
+    def coarse_bounds(self, kx, ky):
+        x0 = kx * COARSE_CHUNK_SIZE
+        y0 = ky * COARSE_CHUNK_SIZE
+        x1 = min(x0 + COARSE_CHUNK_SIZE, self.terrain.size_x)
+        y1 = min(y0 + COARSE_CHUNK_SIZE, self.terrain.size_y)
+        return (x0, y0, x1, y1)
+
+    def coarse_keys(self):
+        nx = (self.terrain.size_x + COARSE_CHUNK_SIZE - 1) // COARSE_CHUNK_SIZE
+        ny = (self.terrain.size_y + COARSE_CHUNK_SIZE - 1) // COARSE_CHUNK_SIZE
+        return [(kx, ky) for kx in range(nx) for ky in range(ny)]
+
+    def coarse_block(self, x, y):
+        # Coarse chunk, first tile and first vertex of the block holding a tile
+        (kx, ky) = self.coarse_of(x, y)
+        (x0, y0, x1, y1) = self.coarse_bounds(kx, ky)
+        blocks_y = (y1 - y0 + COARSE_FACTOR - 1) // COARSE_FACTOR
+        (bx, by) = ((x - x0) // COARSE_FACTOR, (y - y0) // COARSE_FACTOR)
+        return ((kx, ky), x0 + bx * COARSE_FACTOR, y0 + by * COARSE_FACTOR,
+                (bx * blocks_y + by) * VERTS_PER_BOX)
+
+    def block_color(self, bx, by):
+        # Mean colour of the tiles in a block
+        bx1 = min(bx + COARSE_FACTOR, self.terrain.size_x)
+        by1 = min(by + COARSE_FACTOR, self.terrain.size_y)
+        color = [0.0] * 4
+        for x in range(bx, bx1):
+            for i in range(4 * self.terrain_index(x, by), 4 * self.terrain_index(x, by1), 4):
+                for k in range(4):
+                    color[k] += self.colors[i + k]
+        count = (bx1 - bx) * (by1 - by)
+        return [c / count for c in color]
+
+    def build_coarse_chunk(self, kx, ky):
+        (x0, y0, x1, y1) = self.coarse_bounds(kx, ky)
+        geometry = array('f')
+        colors = array('f')
+        indices = array('H')
+        base = 0
+        for bx in range(x0, x1, COARSE_FACTOR):
+            bx1 = min(bx + COARSE_FACTOR, x1)
+            for by in range(y0, y1, COARSE_FACTOR):
+                by1 = min(by + COARSE_FACTOR, y1)
+                top = self.top_height(bx, by, bx1, by1)
+                box = ((0.75 * HEX_DIAM * (bx - 0.5), ROW_SPACING * (by - 0.25), 0.0),
+                        (0.75 * HEX_DIAM * (bx1 - 0.5), ROW_SPACING * (by1 - 0.25), top))
+                for (normal, corners) in BOX_FACES:
+                    for (at_x1, at_y1, at_top) in corners:
+                        geometry.extend((box[at_x1][0], box[at_y1][1], box[at_top][2]) + normal)
+                colors.extend(array('f', self.block_color(bx, by)) * VERTS_PER_BOX)
+                indices.extend([base + k for k in BOX_INDICES])
+                base += VERTS_PER_BOX
+        old = self.coarse_chunks.get((kx, ky))
+        if old:
+            old.removeNode()
+        self.coarse_chunks[(kx, ky)] = self._make_node('coarse', geometry, colors, indices, self.coarse_root)
+        self.coarse_dirty.discard((kx, ky))
+
+    def set_view_width(self, width):
+        # Picks the level of detail for a view this many units across
+        if width / (0.75 * HEX_DIAM) > COARSE_TILES_ACROSS:
+            self.set_level(COARSE)
+        else:
+            self.set_level(FINE)
+
+    def set_level(self, level):
+        self.level = level
+        if not self.fine_root:
+            return
+        if level == COARSE:
+            for (kx, ky) in list(self.coarse_dirty):
+                self.build_coarse_chunk(kx, ky)
+            self.coarse_root.show()
+            self.fine_root.hide()
+        else:
+            self.fine_root.show()
+            self.coarse_root.hide()
+
+    def visible_chunks(self):
+        bounds = base.camLens.makeBounds()
+        bounds.xform(base.cam.getMat(self.terrain.nodePath))
+        visible = []
+        stack = [self.tree]
+        while stack:
+            node = stack.pop()
+            if not bounds.contains(self.node_box(node)):
+                continue
+            if node.children:
+                stack.extend(node.children)
+            else:
+                visible.append(node.keys[:2])
+        return visible
+
+    def stream_task(self, task):
+        # Builds the full-detail chunks coming into view, a few per frame,
+        # and drops the ones longest out of view once there are too many.
+        if self.level != FINE:
+            return task.cont
+        self.frame += 1
+        deadline = globalClock.getRealTime() + STREAM_BUDGET
+        building = True
+        for key in self.visible_chunks():
+            self.last_seen[key] = self.frame
+            if building and key not in self.chunks:
+                self.build_chunk(*key)
+                building = globalClock.getRealTime() < deadline
+        if len(self.chunks) > MAX_CHUNKS:
+            stale = sorted(self.chunks, key=lambda key: self.last_seen.get(key, 0))
+            for key in stale[:len(self.chunks) - MAX_CHUNKS]:
+                if self.last_seen.get(key) != self.frame:
+                    self.chunks.pop(key).removeNode()
+        return task.cont
+
+    def _store_color(self, x, y, color):
+        i = 4 * self.terrain_index(x, y)
+        self.colors[i:i + 4] = array('f', tuple(color))
+
+    def get_tile_color(self, x, y):
+        i = 4 * self.terrain_index(x, y)
+        return VBase4(*self.colors[i:i + 4])
+
+    def set_tile_color(self, x, y, color):
+        self._store_color(x, y, color)
+        self.coarse_colors_changed([(x, y)])
+        nodePath = self.chunks.get(self.chunk_of(x, y))
+        if not nodePath:
+            return
+        vdata = nodePath.node().modifyGeom(0).modifyVertexData()
+        writer = GeomVertexWriter(vdata, 'color')
+        writer.setRow(self.tile_row(x, y))
+        for i in range(VERTS_PER_TILE):
+            writer.setData4f(color[0], color[1], color[2], color[3])
+
+    def set_tile_colors(self, colors):
+        # colors maps (x, y) to a colour. Each chunk touched gets its colour
+        # array replaced once, however many of its tiles changed.
+        dirty = set()
+        for ((x, y), color) in colors.iteritems():
+            self._store_color(x, y, color)
+            dirty.add(self.chunk_of(x, y))
+        for (cx, cy) in dirty:
+            self.upload_colors(cx, cy)
+        self.coarse_colors_changed(colors)
+
+    def upload_colors(self, cx, cy):
+        nodePath = self.chunks.get((cx, cy))
+        if not nodePath:
+            return
+        colors = self.chunk_colors(*self.chunk_bounds(cx, cy))
+        vdata = nodePath.node().modifyGeom(0).modifyVertexData()
+        vdata.modifyArray(1).modifyHandle().setData(colors.tostring())
+
+    def coarse_colors_changed(self, coords):
+        # Recolours the coarse blocks over these tiles if the coarse mesh is
+        # showing, otherwise leaves their chunks to be rebuilt when it is.
+        blocks = set([self.coarse_block(x, y) for (x, y) in coords])
+        for (key, bx, by, row) in blocks:
+            nodePath = self.coarse_chunks.get(key)
+            if self.level != COARSE or not nodePath or key in self.coarse_dirty:
+                self.coarse_dirty.add(key)
+                continue
+            color = self.block_color(bx, by)
+            vdata = nodePath.node().modifyGeom(0).modifyVertexData()
+            writer = GeomVertexWriter(vdata, 'color')
+            writer.setRow(row)
+            for i in range(VERTS_PER_BOX):
+                writer.setData4f(color[0], color[1], color[2], color[3])
+
+    def update_tile(self, x, y):
+        self.update_tiles([(x, y)])
+
+    def update_tiles(self, coords):
+        # Marks the chunks under tiles whose height changed, for rebuild()
+        # to bring up to date once however many edits the frame made
+        for (x, y) in coords:
+            key = self.chunk_of(x, y)
+            # Chunks not built yet get the new heights when they are
+            if key in self.chunks:
+                self.dirty.setdefault(key, set()).add((x, y))
+            self.coarse_dirty.add(self.coarse_of(x, y))
+            node = self.leaves.get(key)
+            height = self.terrain.height_at(x, y)
+            while node and node.top < height:
+                node.top = height
+                node = node.parent
+
+    def rebuild_task(self, task):
+        self.rebuild()
+        return task.cont
+
+    @timed('TerrainMesh.rebuild')
+    def rebuild(self):
+        if self.worker and not self.worker.isAlive():
+            self.worker = None
+            self.install_results()
+        jobs = []
+        for key in self.dirty.keys():
+            coords = self.dirty[key]
+            if key not in self.chunks:
+                # Dropped while streaming
+                del self.dirty[key]
+            elif key in self.building:
+                # The worker has older heights; these columns are patched
+                # once its chunk is in
+                continue
+            elif len(coords) <= PATCH_LIMIT:
+                self.patch_heights(key, coords)
+                del self.dirty[key]
+            elif self.worker is None:
+                jobs.append((key, self.chunk_heights(*self.chunk_bounds(*key))))
+                del self.dirty[key]
+        if jobs:
+            self.start_jobs(jobs)
+        if self.level == COARSE:
+            for key in list(self.coarse_dirty):
+                if key in self.coarse_chunks:
+                    self.build_coarse_chunk(*key)
+
+    def patch_heights(self, key, coords):
+        # Moves the tops of a few columns within a chunk's vertex data
+        vdata = self.chunks[key].node().modifyGeom(0).modifyVertexData()
+        writer = GeomVertexWriter(vdata, 'vertex')
+        positions = self.terrain.get_tables().positions
+        for (x, y) in coords:
+            i = 2 * self.terrain_index(x, y)
+            (px, py) = (positions[i], positions[i + 1])
+            height = self.terrain.height_at(x, y)
+            row = self.tile_row(x, y)
+            for (k, dx, dy) in TOP_VERTICES:
+                writer.setRow(row + k)
+                writer.setData3f(px + dx, py + dy, height)
+
+    def start_jobs(self, jobs):
+        # jobs are (chunk, heights) pairs
+        self.building = set([key for (key, heights) in jobs])
+        self.results = []
+        if self.threaded:
+            self.worker = threading.Thread(target=self.tessellate_jobs, args=(jobs, self.results))
+            self.worker.start()
+        else:
+            self.tessellate_jobs(jobs, self.results)
+            self.install_results()
+
+    def tessellate_jobs(self, jobs, results):
+        # Runs on the worker thread, so it only reads the heights it is
+        # given and the fixed board tables
+        for (key, heights) in jobs:
+            results.append((key,) + self.tessellate(*self.chunk_bounds(*key), heights=heights))
+
+    def install_results(self):
+        for (key, geometry, indices) in self.results:
+            # Colours are taken now, as they may have changed meanwhile.
+            # Chunks dropped or built afresh since are left alone.
+            if key in self.building and key in self.chunks:
+                self.install_chunk(key, geometry, self.chunk_colors(*self.chunk_bounds(*key)), indices)
+        self.results = []
+        self.building = set()
+
+    def tile_at(self, point):
+        # Tile under a point in terrain space, e.g. a collision surface point
+        # nudged just inside the column that was hit.
+        (x, y) = point_to_offset(point.getX() / HEX_DIAM, point.getY() / HEX_DIAM)
+        if 0 <= x < self.terrain.size_x and 0 <= y < self.terrain.size_y:
+            return self.terrain.tile(x, y)
+        return None
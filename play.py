@@ -1,13 +1,18 @@
 #!/usr/bin/python
 
-import cPickle, random, operator
+import random
+import direct.directbase.DirectStart
 from direct.showbase.DirectObject import DirectObject
-from pandac.PandaModules import Point2, Point3
+from pandac.PandaModules import Point2, Point3, VBase4
 from direct.fsm import FSM
 from direct.interval.IntervalGlobal import *
 from direct.gui.DirectGui import *
 from hexabots import World, Mouse, Tile, Character
-from hexabots import HEX_DIAM, board_coordinates, find_nearby, tile_distance_squared
+from hexabots import find_nearby
+from hexabots import battle, search
+from hexabots.battle import MOVE_RANGE, ATTACK_RANGE
+from hexabots.loading import WorldLoader
+from hexabots.profiling import timed, install_keys
 
 
 """
@@ -62,102 +67,59 @@ Movement modes:
 
 
 def cleanup():
-    for team in app.world.teams:
-        for character in team.characters:
-            if not character.is_dead and character.should_die():
-                character.die()
+    battle.cleanup(app.world)
 
 def game_over():
-    teams_alive = []
-    for team in app.world.teams:
-        if not reduce(operator.and_, [c.is_dead for c in team.characters]):
-            teams_alive.append(team)
+    teams_alive = battle.teams_alive(app.world)
     if len(teams_alive) == 1:
         app.winner = OnscreenText(text='%s wins!' % (teams_alive[0].name,), pos=(-0.9, -0.8), fg=(1.0, 1.0, 1.0, 1.0))
         return True
     return False
 
+@timed('charge')
 def charge(task):
     cleanup()
     if game_over():
         app.state.request('AwaitLoad')
         return task.done
-    while True:
-        for team in app.world.teams:
-            for character in team.characters:
-                if character.is_dead:
-                    continue
-                character.charge(0.001)
-                if character.CT >= 1.0:
-                    if character.team.name == 'Team 1':
-                        app.state.request('Team1', character)
-                        return task.done
-                    if character.team.name == 'Team 2':
-                        app.state.request('Team2', character)
-                        return task.done
+    character = app.world.scheduler.next_actor()
+    if character:
+        if character.team.name == 'Team 1':
+            app.state.request('Team1', character)
+            return task.done
+        if character.team.name == 'Team 2':
+            app.state.request('Team2', character)
+            return task.done
     return task.cont
 
-def find_opponent(teams, character):
-    least_distance = 999999999
-    closest_opponent = None
-    for team in teams:
-        if team == character.team:
-            continue
-        for other_character in team.characters:
-            if other_character.is_dead:
-                continue
-            distance = tile_distance_squared(other_character.tile, character.tile)
-            if distance < least_distance:
-                least_distance = distance
-                closest_opponent = other_character
-    return closest_opponent
-
-
-class Move(object):
-    def __init__(self, mover, tile):
-        self.mover = mover
-        self.tile = tile
-
-    def pre_cost(self):
-        return 0.0
-
-    def post_cost(self):
-        import math
-        distance = math.sqrt(tile_distance_squared(self.mover.tile, self.tile))
-        return distance / HEX_DIAM / 3.5
 
+class Move(battle.Move):
     def do(self):
-        inhabitants = self.tile.get_inhabitants()
-        if inhabitants:
+        if not self.find_path():
             # TODO: Maybe move somewhere else?
             app.state.demand('Charge')
         else:
-            to_coords = Point3(*board_coordinates(self.tile.x, self.tile.y, self.tile.height))
-            i_move = LerpPosInterval(self.mover.nodePath, 0.5, to_coords)
+            intervals = []
+            for tile in self.path.tiles[1:]:
+                to_coords = Point3(*tile.terrain.position(tile.x, tile.y, tile.height))
+                intervals.append(LerpPosInterval(self.mover.nodePath, 0.15, to_coords))
             i_finish = Func(self.post_do)
-            i_sequence = Sequence(i_move, i_finish)
+            i_sequence = Sequence(*(intervals + [i_finish]))
             i_sequence.start()
 
     def post_do(self):
-        self.mover.move_to(self.tile)
+        self.finish()
         app.state.request('Charge')
 
 
-class Attack(object):
-    def __init__(self, attacker, target):
-        self.attacker = attacker
-        self.target = target
-
-    def pre_cost(self):
-        return 0.2
-
-    def post_cost(self):
-        return 0.2
-
+class Attack(battle.Attack):
     def do(self):
-        # TODO: Make sure target is still in range
-        from_coords = Point3(*board_coordinates(self.attacker.x, self.attacker.y, self.attacker.height))
-        to_coords = Point3(*board_coordinates(self.target.x, self.target.y, self.target.height))
+        if not self.can_hit():
+            app.state.demand('Charge')
+            return
+        terrain = self.attacker.terrain
+        from_coords = Point3(*terrain.position(self.attacker.x, self.attacker.y, self.attacker.height))
+        to_coords = Point3(*terrain.position(self.target.x, self.target.y, self.target.height))
         i_move_to = LerpPosInterval(self.attacker.nodePath, 0.1, to_coords, blendType='easeIn')
         i_move_from = LerpPosInterval(self.attacker.nodePath, 0.1, from_coords, blendType='easeOut')
         i_finish = Func(self.post_do)
@@ -165,16 +127,28 @@ class Attack(object):
         i_sequence.start()
 
     def post_do(self):
-        self.target.damage(0.2)
+        self.finish()
         app.state.request('Charge')
 
 
+class Wait(battle.Wait):
+    def do(self):
+        app.state.demand('Charge')
+
+
+MOVE_COLOR = VBase4(0.5, 0.6, 1.0, 1.0)
+ATTACK_COLOR = VBase4(1.0, 0.6, 0.5, 1.0)
+
+
 class PlayState(FSM.FSM):
     def __init__(self, name):
         FSM.FSM.__init__(self, name)
         self.character = None
         self.movement_candidates = []
 
+    request = timed('PlayState.request')(FSM.FSM.request)
+    demand = timed('PlayState.demand')(FSM.FSM.demand)
+
     def enterAwaitLoad(self):
         app.welcome = OnscreenText(text='Press L to load a level', pos=(-0.9, -0.9), fg=(1.0, 1.0, 1.0, 1.0))
 
@@ -183,6 +157,25 @@ class PlayState(FSM.FSM):
         if app.winner:
             app.winner.destroy()
 
+    def enterLoading(self, filename):
+        app.world_loader = WorldLoader(filename, self.loaded)
+
+    def loaded(self, world):
+        app.world_loader = None
+        if not world:
+            self.request('AwaitLoad')
+            return
+        app.world = world
+        app.world.position_camera()
+        app.world.init_scheduler()
+        app.world.init_fog(app.world.teams[0])
+        self.request('Charge')
+
+    def exitLoading(self):
+        if app.world_loader:
+            app.world_loader.cancel()
+            app.world_loader = None
+
     def enterCharge(self):
         taskMgr.add(charge, 'charge')
 
@@ -207,23 +200,18 @@ class PlayState(FSM.FSM):
     def enterTeam1(self, character):
         app.mouse.task = app.mouse.hover
         self.character = character
-        self.movement_candidates = find_nearby(app.world.terrain, character.x, character.y, 3.5)
-        self.attack_candidates = find_nearby(app.world.terrain, character.x, character.y, 1.0)
-        for tile in self.movement_candidates:
-            tile.nodePath.setColor(0.5, 0.6, 1.0)
-            if app.world.terrain.hoveredTile == tile:
-                tile.nodePath.setColor(0.75, 0.9, 1.5)
-        for tile in self.attack_candidates:
-            tile.nodePath.setColor(1.0, 0.6, 0.5)
-            if app.world.terrain.hoveredTile == tile:
-                tile.nodePath.setColor(1.5, 0.9, 0.75)
+        pathfinder = app.world.terrain.get_pathfinder()
+        self.movement_candidates = pathfinder.reachable_from(character, MOVE_RANGE).tiles()
+        self.attack_candidates = find_nearby(app.world.terrain, character.x, character.y, ATTACK_RANGE)
+        highlights = app.world.terrain.get_highlights()
+        highlights.show('move', self.movement_candidates, MOVE_COLOR)
+        highlights.show('attack', self.attack_candidates, ATTACK_COLOR)
 
     def exitTeam1(self):
         app.mouse.task = None
         app.mouse.hovered_object.unhover()
         app.mouse.hovered_object = None
-        for tile in self.movement_candidates:
-            tile.change_material(tile.material)
+        app.world.terrain.get_highlights().clear()
         self.movement_candidates = None
         self.attack_candidates = None
         self.character = None
@@ -247,30 +235,18 @@ class PlayState(FSM.FSM):
         return None
 
     def enterTeam2(self, character):
-        player = find_opponent(app.world.teams, character)
-        self.movement_candidates = find_nearby(app.world.terrain, character.x, character.y, 3.5)
-        self.attack_candidates = find_nearby(app.world.terrain, character.x, character.y, 1.0)
-        if player.tile in self.attack_candidates:
-            character.set_action(Attack(character, player))
+        self.character = character
+        action = search.choose_action(app.world, character, time_budget=search.TIME_BUDGET)
+        if isinstance(action, battle.Move):
+            action = Move(character, action.tile)
+        elif isinstance(action, battle.Attack):
+            action = Attack(character, action.target)
         else:
-            shortest_distance = 10000000
-            closest_tile = None
-            for tile in self.movement_candidates:
-                if tile.get_inhabitants():
-                    continue
-                vector = Point2(tile.x, tile.y) - Point2(player.x, player.y)
-                distance = vector.lengthSquared()
-                if distance < shortest_distance and distance > 0:
-                    shortest_distance = distance
-                    closest_tile = tile
-            character.set_action(Move(character, closest_tile))
+            action = Wait(character)
+        character.set_action(action)
         self.demand('Charge')
 
     def exitTeam2(self):
-        for tile in self.movement_candidates:
-            tile.change_material(tile.material)
-        self.movement_candidates = None
-        self.attack_candidates = None
         self.character = None
 
 
@@ -286,18 +262,16 @@ class PlayApp(DirectObject):
         self.state = PlayState('state')
         self.accept('l', self.load_world)
         self.accept('L', self.load_world)
+        install_keys(self)
         self.welcome = None
         self.winner = None
+        self.world_loader = None
 
     def load_world(self):
         def load(filename):
-            self.delete_world()
-            F = open(filename, 'rb')
-            self.world = cPickle.load(F)
-            F.close()
             entry.destroy()
-            self.world.position_camera()
-            self.state.request('Charge')
+            self.delete_world()
+            self.state.request('Loading', filename)
         self.welcome.removeNode()
         self.state.request('AwaitLoad')
         entry = DirectEntry(text='', scale=0.05, command=load,